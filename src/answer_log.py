@@ -0,0 +1,249 @@
+# answers への書き込みを遅延させるライトビハインドログ
+#
+# append() は回答レコードをローカルのスピルファイル（JSONL）に追記してすぐに戻り、
+# バックグラウンドのスレッドが件数（batch_size）または時間（interval 秒）の閾値で
+# まとめて Firestore の answers に書き込む。
+#
+# - 各レコードには追記時にドキュメント ID を割り当てるため、再送しても重複しない
+# - スピルファイルはフラッシュのたびに新しいセグメントに切り替え、書き込みが
+#   完了したセグメントから削除する。起動時に残っているセグメントは再送する
+# - 複数ワーカーで同じディレクトリを使えるよう、セグメント名にはインスタンスごとの
+#   ID を含め、削除するまで flock を持ち続ける。起動時の再送はロックを取れた
+#   （持ち主のプロセスが終了している）セグメントだけを対象にする
+# - close() は残りを書き込んでからスレッドを止める。失敗した分はスピルファイルに残り、
+#   次回起動時に再送される
+
+import json
+import logging
+import os
+import threading
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from metrics import ANSWER_LOG_RECORDS
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger("quiz.answer_log")
+
+BATCH_LIMIT = 500
+MAX_BACKOFF_SECONDS = 30.0
+
+
+def _encode(record: Dict) -> Dict:
+    return {k: {"$datetime": v.isoformat()} if isinstance(v, datetime) else v for k, v in record.items()}
+
+
+def _decode(record: Dict) -> Dict:
+    return {
+        k: datetime.fromisoformat(v["$datetime"]) if isinstance(v, dict) and "$datetime" in v else v
+        for k, v in record.items()
+    }
+
+
+def _try_lock(f) -> bool:
+    # fcntl が無い環境（Windows）では 1 プロセスで使う前提でロックしない
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+
+class AnswerLog:
+    def __init__(
+        self,
+        db,
+        directory: Path,
+        batch_size: int = 200,
+        interval: float = 1.0,
+        fsync: bool = False,
+        collection: str = "answers",
+    ):
+        self.db = db
+        self.directory = Path(directory)
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self.fsync = fsync
+        self.collection = collection
+        self._cond = threading.Condition()
+        # スピルファイルへの書き込み（fsync を含む）とセグメントの切り替えを直列化する。
+        # _cond と両方取る場合は _io_lock を先に取る
+        self._io_lock = threading.Lock()
+        self._pending: List[Tuple[str, Dict]] = []
+        # 書き込み待ちのレコードを含む、切り替え済みのセグメント
+        self._sealed: List[Path] = []
+        # ロックを保持しているセグメント（書き込み中・切り替え済み・再送中）。削除時に閉じる
+        self._handles: Dict[Path, object] = {}
+        self._segment = None
+        self._segment_path: Optional[Path] = None
+        self._segment_no = 0
+        self._owner = uuid.uuid4().hex[:16]
+        self._closed = False
+        self._failures = 0
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def start(self) -> "AnswerLog":
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._recover()
+        self._open_segment()
+        self._thread = threading.Thread(target=self._run, name="answer-log", daemon=True)
+        self._thread.start()
+        return self
+
+    def _recover(self) -> None:
+        for path in sorted(self.directory.glob("answers.*.jsonl")):
+            f = self._adopt(path)
+            if f is None:
+                continue
+            count = len(self._pending)
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 追記途中で停止した末尾の行は読み捨てる
+                    continue
+                self._pending.append((entry["id"], _decode(entry["data"])))
+            self._handles[path] = f
+            if len(self._pending) > count:
+                self._sealed.append(path)
+            else:
+                self._release(path, unlink=True)
+        if self._pending:
+            logger.info("answer_log: recovered %d records from %d segments", len(self._pending), len(self._sealed))
+
+    def _adopt(self, path: Path):
+        # ロックを取れないセグメントは稼働中の別ワーカーのもの。開いてからロックを取るまでに
+        # 持ち主が書き込みを終えて削除していた場合も読まない
+        try:
+            f = open(path, "r", encoding="utf-8")
+        except FileNotFoundError:
+            return None
+        try:
+            if _try_lock(f) and os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+                return f
+        except FileNotFoundError:
+            pass
+        f.close()
+        return None
+
+    def _open_segment(self) -> None:
+        self._segment_no += 1
+        self._segment_path = self.directory / f"answers.{self._owner}.{self._segment_no:08d}.jsonl"
+        self._segment = open(self._segment_path, "a", encoding="utf-8")
+        if not _try_lock(self._segment):
+            raise RuntimeError(f"{self._segment_path} is locked by another process")
+        self._handles[self._segment_path] = self._segment
+
+    def _seal_segment(self) -> None:
+        # 書き込みは終わるがロックは削除まで持ち続ける
+        self._segment.flush()
+        self._sealed.append(self._segment_path)
+        self._open_segment()
+
+    def _release(self, path: Path, unlink: bool) -> None:
+        # 削除してからロックを外す（外した直後に別ワーカーに再送されないように）
+        if unlink:
+            try:
+                path.unlink()
+            except OSError as e:
+                logger.warning("answer_log: could not remove %s: %s", path, e)
+        f = self._handles.pop(path, None)
+        if f is not None:
+            f.close()
+
+    def append(self, records: List[Dict]) -> bool:
+        # False の場合（停止済み）は呼び出し側で直接書き込む。
+        # ファイルに書き込むため、イベントループからはスレッドプール経由で呼ぶ
+        items = [(uuid.uuid4().hex, record) for record in records]
+        lines = "".join(
+            json.dumps({"id": doc_id, "data": _encode(record)}, ensure_ascii=False) + "\n"
+            for doc_id, record in items
+        )
+        with self._io_lock:
+            if self._closed:
+                return False
+            self._segment.write(lines)
+            self._segment.flush()
+            if self.fsync:
+                os.fsync(self._segment.fileno())
+            with self._cond:
+                self._pending.extend(items)
+                ANSWER_LOG_RECORDS.inc(("appended",), len(items))
+                if len(self._pending) >= self.batch_size:
+                    self._cond.notify()
+        return True
+
+    def _flush(self, items: List[Tuple[str, Dict]]) -> None:
+        coll = self.db.collection(self.collection)
+        for start in range(0, len(items), BATCH_LIMIT):
+            batch = self.db.batch()
+            for doc_id, record in items[start:start + BATCH_LIMIT]:
+                batch.set(coll.document(doc_id), record)
+            batch.commit()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if not self._closed:
+                    if self._failures:
+                        self._cond.wait(min(MAX_BACKOFF_SECONDS, self.interval * 2 ** self._failures))
+                    elif len(self._pending) < self.batch_size:
+                        self._cond.wait(self.interval)
+            with self._io_lock, self._cond:
+                closing = self._closed
+                items, self._pending = self._pending, []
+                if items and self._segment.tell():
+                    self._seal_segment()
+                sealed = list(self._sealed)
+
+            if items:
+                try:
+                    self._flush(items)
+                except Exception as e:
+                    logger.warning("answer_log: flush of %d records failed: %s", len(items), e)
+                    ANSWER_LOG_RECORDS.inc(("failed",), len(items))
+                    with self._cond:
+                        self._pending[:0] = items
+                        self._failures += 1
+                else:
+                    ANSWER_LOG_RECORDS.inc(("flushed",), len(items))
+                    with self._cond:
+                        self._failures = 0
+                        # このスナップショットに含まれたセグメントは全件書き込み済み
+                        self._sealed = [p for p in self._sealed if p not in sealed]
+                        for path in sealed:
+                            self._release(path, unlink=True)
+                    logger.info("answer_log: flushed %d records", len(items))
+
+            if closing:
+                with self._io_lock, self._cond:
+                    self._segment.flush()
+                    self._release(self._segment_path, unlink=self._segment.tell() == 0)
+                    # 残ったセグメントはロックを外し、次に起動したワーカーが再送する
+                    for path in list(self._handles):
+                        self._release(path, unlink=False)
+                    if self._pending:
+                        logger.warning("answer_log: %d records left in %s", len(self._pending), self.directory)
+                return
+
+    def close(self, timeout: Optional[float] = 30.0) -> None:
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
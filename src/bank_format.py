@@ -0,0 +1,131 @@
+# 問題バンクのバイナリ形式（mmap でそのまま参照できる列指向レイアウト）
+#
+# ヘッダ:  magic(8) | format version(u32) | 問題数(u32) | セクション数(u32) | 予約(u32)
+# セクション表: (offset u64, length u64) × セクション数
+# 各セクションは 8 バイト境界に配置し、memoryview.cast で直接配列として扱う。
+# 数値はすべてリトルエンディアン。
+
+import mmap
+import os
+import struct
+import sys
+from array import array
+from pathlib import Path
+from typing import Dict, List
+
+MAGIC = b"KUIZBNK1"
+FORMAT_VERSION = 1
+
+_HEADER = struct.Struct("<8sIIII")
+_SECTION = struct.Struct("<QQ")
+
+# (セクション名, memoryview.cast のフォーマット)。文字列リストは offsets + blob の 2 セクションで表す
+_SECTIONS = [
+    ("ids.offsets", "Q"),
+    ("ids.blob", "B"),
+    ("categories.offsets", "Q"),
+    ("categories.blob", "B"),
+    ("category_ids", "H"),
+    ("answer_col", "h"),
+    ("has_explanation", "B"),
+    ("slot_start", "I"),
+    ("text_offsets", "Q"),
+    ("text", "B"),
+]
+
+
+def _pack_strings(values: List[str]):
+    offsets = array("Q", [0])
+    chunks = []
+    total = 0
+    for value in values:
+        encoded = value.encode("utf-8")
+        chunks.append(encoded)
+        total += len(encoded)
+        offsets.append(total)
+    return offsets, b"".join(chunks)
+
+
+def _unpack_strings(offsets, blob) -> List[str]:
+    return [str(blob[offsets[i]:offsets[i + 1]], "utf-8") for i in range(len(offsets) - 1)]
+
+
+def _as_bytes(value) -> bytes:
+    if isinstance(value, array):
+        if value.itemsize > 1 and sys.byteorder != "little":
+            value = array(value.typecode, value)
+            value.byteswap()
+        return value.tobytes()
+    return bytes(value)
+
+
+def write_bank(path: Path, columns: Dict) -> None:
+    ids_offsets, ids_blob = _pack_strings(columns["ids"])
+    cat_offsets, cat_blob = _pack_strings(columns["category_names"])
+    payloads = {
+        "ids.offsets": ids_offsets,
+        "ids.blob": ids_blob,
+        "categories.offsets": cat_offsets,
+        "categories.blob": cat_blob,
+        "category_ids": columns["category_ids"],
+        "answer_col": columns["answer_col"],
+        "has_explanation": columns["has_explanation"],
+        "slot_start": columns["slot_start"],
+        "text_offsets": columns["text_offsets"],
+        "text": columns["text"],
+    }
+    body = bytearray()
+    table = []
+    data_start = _HEADER.size + _SECTION.size * len(_SECTIONS)
+    data_start += -data_start % 8
+    for name, _ in _SECTIONS:
+        raw = _as_bytes(payloads[name])
+        body += b"\0" * (-len(body) % 8)
+        table.append((data_start + len(body), len(raw)))
+        body += raw
+
+    header = _HEADER.pack(MAGIC, FORMAT_VERSION, len(columns["ids"]), len(_SECTIONS), 0)
+    header += b"".join(_SECTION.pack(offset, length) for offset, length in table)
+    header += b"\0" * (data_start - len(header))
+
+    path = Path(path)
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(header)
+        f.write(body)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def read_bank(path: Path) -> Dict:
+    if sys.byteorder != "little":
+        raise ValueError("bank files can only be mapped on little-endian hosts")
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+    magic, version, count, n_sections, _ = _HEADER.unpack_from(view, 0)
+    if magic != MAGIC or version != FORMAT_VERSION or n_sections != len(_SECTIONS):
+        raise ValueError(f"{path}: unsupported bank file")
+
+    sections = {}
+    for i, (name, fmt) in enumerate(_SECTIONS):
+        offset, length = _SECTION.unpack_from(view, _HEADER.size + i * _SECTION.size)
+        if offset + length > len(view):
+            raise ValueError(f"{path}: truncated section {name}")
+        sections[name] = view[offset:offset + length].cast(fmt)
+
+    columns = {
+        "ids": _unpack_strings(sections["ids.offsets"], sections["ids.blob"]),
+        "category_names": _unpack_strings(sections["categories.offsets"], sections["categories.blob"]),
+        "category_ids": sections["category_ids"],
+        "answer_col": sections["answer_col"],
+        "has_explanation": sections["has_explanation"],
+        "slot_start": sections["slot_start"],
+        "text_offsets": sections["text_offsets"],
+        "text": sections["text"],
+        "mmap": mm,
+    }
+    if len(columns["ids"]) != count or len(columns["slot_start"]) != count + 1:
+        raise ValueError(f"{path}: inconsistent question count")
+    return columns
@@ -0,0 +1,274 @@
+# クイズ API のベンチマーク
+#
+#   python benchmark.py [--mode file|sqlite|emulator] [--questions 1000,10000,100000] [--users 50]
+#                       [--requests 2000] [--concurrency 16] [--endpoints batch,next,answers,session]
+#                       [--history 30] [--json results.json] [--base-url URL]
+#
+# 合成した問題バンクと合成ユーザーで各エンドポイントを叩き、p50/p95/p99 レイテンシ、
+# スループット、1 リクエストあたりの Firestore 操作数（Server-Timing ヘッダ）を表示する。
+# 既定ではアプリをプロセス内（ASGI）で直接呼び出す。--base-url を指定すると起動済みの
+# サーバーに対して実行する（この場合バンクは注入できず、サーバーの問題をそのまま使う）。
+#
+# file:     Firestore を使わないモード（get_db() が常に None を返す状態）で計測する
+# sqlite:   SQLite ストア（QUIZ_STORE=sqlite）で計測する。--sqlite-path（既定は一時ファイル）を使う
+# emulator: Firestore エミュレータに対して計測する。専用のプロジェクトで実行すること:
+#   FIRESTORE_EMULATOR_HOST=localhost:8080 GOOGLE_CLOUD_PROJECT=demo-kuiz-bench \
+#       python benchmark.py --mode emulator --reset
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import sys
+import time
+import tempfile
+import urllib.request
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+import main
+
+ENDPOINTS = ("batch", "next", "answers", "session")
+SESSION_SIZE = 30
+
+
+def synthetic_records(count: int, categories: int = 12, seed: int = 0) -> List[Dict]:
+    rng = random.Random(seed)
+    records = []
+    for i in range(count):
+        options = [f"選択肢 {i}-{k} " + "あ" * rng.randint(4, 40) for k in range(4)]
+        records.append(
+            main._question_record(
+                f"bench-{i}",
+                f"カテゴリ{i % categories:02d}",
+                f"問題 {i}: " + "い" * rng.randint(40, 400),
+                options,
+                rng.randrange(4),
+                "解説 " + "う" * rng.randint(0, 300) if rng.random() < 0.8 else None,
+            )
+        )
+    return records
+
+
+def parse_server_timing(header: str) -> Dict[str, float]:
+    # "total;dur=1.23, db;dur=0.45, db-reads;desc="3"" → {"total": 1.23, "db": 0.45, "db-reads": 3}
+    values = {}
+    for entry in header.split(","):
+        name, *params = [part.strip() for part in entry.split(";")]
+        for param in params:
+            key, _, value = param.partition("=")
+            if key in ("dur", "desc"):
+                try:
+                    values[name] = float(value.strip('"'))
+                except ValueError:
+                    pass
+    return values
+
+
+def _percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * p
+    lo, hi = math.floor(k), math.ceil(k)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def _request_args(endpoint: str, user_id: str, question_ids: List[str], rng: random.Random):
+    if endpoint == "batch":
+        return "GET", "/api/v1/questions/batch", {"params": {"userId": user_id, "limit": 30}}
+    if endpoint == "next":
+        return "GET", "/api/v1/questions/next", {"params": {"userId": user_id}}
+    if endpoint == "answers":
+        body = {
+            "userId": user_id,
+            "questionId": rng.choice(question_ids),
+            "choice": rng.randrange(4),
+            "elapsedMs": rng.randint(1000, 20000),
+        }
+        return "POST", "/api/v1/answers", {"json": body}
+    results = [
+        {"questionId": qid, "choice": rng.randrange(4), "elapsedMs": rng.randint(1000, 20000)}
+        for qid in rng.sample(question_ids, min(SESSION_SIZE, len(question_ids)))
+    ]
+    return "POST", "/api/v1/session/results", {"json": {"userId": user_id, "results": results}}
+
+
+async def run_phase(
+    client: httpx.AsyncClient,
+    endpoint: str,
+    users: List[str],
+    question_ids: List[str],
+    requests: int,
+    concurrency: int,
+    seed: int,
+) -> Dict:
+    rng = random.Random(seed)
+    latencies: List[float] = []
+    errors = Counter()
+    ops = Counter()
+    timed = 0
+    remaining = iter(range(requests))
+
+    async def _worker():
+        nonlocal timed
+        for i in remaining:
+            method, url, kwargs = _request_args(endpoint, users[i % len(users)], question_ids, rng)
+            start = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors[response.status_code] += 1
+            # Firestore 操作数はサーバーが返す Server-Timing ヘッダから集計する
+            timing = parse_server_timing(response.headers.get("server-timing", ""))
+            if timing:
+                timed += 1
+                ops.update({k[3:]: v for k, v in timing.items() if k.startswith("db-")})
+                ops["db_ms"] += timing.get("db", 0.0)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(_worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    result = {
+        "endpoint": endpoint,
+        "requests": requests,
+        "errors": dict(errors),
+        "seconds": round(elapsed, 3),
+        "throughput": round(requests / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(_percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(_percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(_percentile(latencies, 0.99) * 1000, 2),
+    }
+    if timed:
+        result["ops_per_request"] = {k: round(v / timed, 2) for k, v in sorted(ops.items())}
+    return result
+
+
+def reset_emulator() -> None:
+    host = os.environ["FIRESTORE_EMULATOR_HOST"]
+    project = os.environ["GOOGLE_CLOUD_PROJECT"]
+    url = f"http://{host}/emulator/v1/projects/{project}/databases/(default)/documents"
+    urllib.request.urlopen(urllib.request.Request(url, method="DELETE")).close()
+
+
+def configure_mode(mode: str, reset: bool, sqlite_path: Optional[str] = None) -> None:
+    if mode in ("file", "sqlite"):
+        # 認証情報があっても Firestore に接続しない
+        main._db = None
+        main._db_failed_at = time.monotonic()
+        main.DB_RETRY_SECONDS = math.inf
+        if mode == "sqlite":
+            main.STORE = "sqlite"
+            main.SQLITE_PATH = Path(sqlite_path or tempfile.mkdtemp(prefix="quiz-bench-")) / "bench.sqlite3"
+            if main.get_sqlite_store() is None:
+                raise SystemExit(f"could not open {main.SQLITE_PATH}")
+        return
+    if not os.getenv("FIRESTORE_EMULATOR_HOST") or not os.getenv("GOOGLE_CLOUD_PROJECT"):
+        raise SystemExit("emulator mode requires FIRESTORE_EMULATOR_HOST and GOOGLE_CLOUD_PROJECT")
+    if reset:
+        reset_emulator()
+    if main.get_db() is None:
+        raise SystemExit("could not connect to the Firestore emulator")
+
+
+async def run_bank(args, size: int) -> List[Dict]:
+    users = [f"bench-user-{i}" for i in range(args.users)]
+    if args.base_url:
+        client = httpx.AsyncClient(base_url=args.base_url, timeout=60)
+        question_ids = None
+    else:
+        bank = main.QuestionBank(synthetic_records(size, seed=args.seed))
+        main._swap_bank(bank)
+        # 計測中に TTL でバンクが読み直されないようにする
+        main.BANK_TTL_SECONDS = math.inf
+        question_ids = list(bank.ids)
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench", timeout=60)
+
+    results = []
+    async with client:
+        if question_ids is None:
+            response = await client.get("/api/v1/questions")
+            question_ids = [q["id"] for q in response.json()]
+        if args.history:
+            # 各ユーザーに学習履歴を持たせてからスケジューラを計測する
+            rng = random.Random(args.seed)
+            for user_id in users:
+                for start in range(0, args.history, SESSION_SIZE):
+                    sample = rng.sample(question_ids, min(SESSION_SIZE, args.history - start, len(question_ids)))
+                    body = {
+                        "userId": user_id,
+                        "results": [
+                            {"questionId": qid, "choice": rng.randrange(4), "elapsedMs": rng.randint(1000, 20000)}
+                            for qid in sample
+                        ],
+                    }
+                    await client.post("/api/v1/session/results", json=body)
+        for endpoint in args.endpoints:
+            # 計測前に数リクエスト流してキャッシュとコネクションを温める
+            await run_phase(client, endpoint, users, question_ids, min(len(users), 20), 1, args.seed)
+            result = await run_phase(
+                client, endpoint, users, question_ids, args.requests, args.concurrency, args.seed
+            )
+            result["questions"] = len(question_ids)
+            result["mode"] = "remote" if args.base_url else args.mode
+            results.append(result)
+            _print_result(result)
+    return results
+
+
+def _print_result(result: Dict) -> None:
+    ops = result.get("ops_per_request")
+    ops_text = " ".join(f"{k}={v}" for k, v in ops.items()) if ops else "-"
+    print(
+        f"{result['mode']:8} n={result['questions']:<7} {result['endpoint']:8} "
+        f"p50={result['p50_ms']:8.2f}ms p95={result['p95_ms']:8.2f}ms p99={result['p99_ms']:8.2f}ms "
+        f"rps={result['throughput']:8.1f} errors={sum(result['errors'].values())} ops[{ops_text}]",
+        flush=True,
+    )
+
+
+def main_cli(argv=None) -> List[Dict]:
+    parser = argparse.ArgumentParser(description="クイズ API のベンチマーク")
+    parser.add_argument("--mode", choices=("file", "sqlite", "emulator"), default="file")
+    parser.add_argument("--sqlite-path", help="sqlite モードでデータベースを置くディレクトリ")
+    parser.add_argument("--questions", default="1000,10000,100000", help="合成バンクの問題数（カンマ区切り）")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=2000, help="エンドポイントごとのリクエスト数")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS))
+    parser.add_argument("--history", type=int, default=0, help="計測前に各ユーザーが回答しておく問題数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--reset", action="store_true", help="開始前にエミュレータのデータを全削除する")
+    parser.add_argument("--base-url", help="起動済みのサーバーに対して実行する")
+    parser.add_argument("--json", type=argparse.FileType("w", encoding="utf-8"), help="結果を JSON で保存する")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args(argv)
+
+    args.endpoints = [e for e in args.endpoints.split(",") if e]
+    unknown = set(args.endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"unknown endpoints: {', '.join(sorted(unknown))}")
+    sizes = [int(n) for n in args.questions.split(",") if n]
+
+    logging.basicConfig(level=args.log_level.upper())
+    logging.getLogger("quiz").setLevel(args.log_level.upper())
+    if not args.base_url:
+        configure_mode(args.mode, args.reset, args.sqlite_path)
+
+    results = []
+    for size in sizes if not args.base_url else sizes[:1]:
+        results += asyncio.run(run_bank(args, size))
+    if args.json:
+        json.dump(results, args.json, ensure_ascii=False, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main_cli(sys.argv[1:])
@@ -0,0 +1,27 @@
+# data/*.json を正規化し、mmap で読み込めるバイナリ形式の問題バンクにまとめる
+#
+#   python compile_bank.py [--output PATH]
+#
+# 出力先の既定値はサーバーと同じ QUIZ_BANK_FILE（未指定なら data/questions.bank）。
+# data/*.json を更新したら再実行すること（古いバンクファイルはサーバー側で無視される）。
+
+import argparse
+from pathlib import Path
+
+from bank_format import write_bank
+from main import BANK_FILE, QuestionBank, _load_questions_from_file
+
+
+def compile_bank(output: Path = BANK_FILE) -> QuestionBank:
+    bank = QuestionBank(_load_questions_from_file())
+    write_bank(output, bank.columns())
+    return bank
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="問題バンクをバイナリ形式にコンパイルする")
+    parser.add_argument("--output", type=Path, default=BANK_FILE)
+    args = parser.parse_args()
+
+    bank = compile_bank(args.output)
+    print(f"Compiled {len(bank)} questions into {args.output}")
@@ -1,76 +1,154 @@
 # C:\Users\dance\zone\kihon\kuiz\import_questions.py
+#
+#   python import_questions.py [--dry-run] [--workers 8] [--keep-removed]
+#
+# data/*.json と Firestore の questions を contentHash で比較し、追加・変更・削除のあった
+# ドキュメントだけを 500 件単位のバッチで並列に書き込む。途中で失敗しても、書き込み済みの
+# ドキュメントは次回の差分に現れないため、同じコマンドを再実行すれば続きから再開できる。
+# meta/questions には内容全体のハッシュも記録し、バージョン更新の前に中断した場合は
+# 再実行時に差分が無くてもバージョンを更新する。
+# エミュレータに対して実行する場合:
+#   FIRESTORE_EMULATOR_HOST=localhost:8080 GOOGLE_CLOUD_PROJECT=demo-kuiz python import_questions.py
 import os
-import json
+import argparse
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 from pathlib import Path
 import firebase_admin
 from firebase_admin import credentials, firestore
 
+from ingest import content_hash, ingest, source_files
+
+# Firestore の WriteBatch は 1 回あたり 500 件まで
+BATCH_LIMIT = 500
+
 # サービスアカウントキーのパス
 project_root = Path(__file__).parent.parent
 key_file = project_root / ".key" / "kuiz-ebfe2-c3bc78e92553.json"
+data_dir = project_root / "data"
+
+
+def get_client():
+    # Firebase 初期化
+    if not len(firebase_admin._apps):
+        if key_file.exists():
+            cred = credentials.Certificate(str(key_file))
+            firebase_admin.initialize_app(cred)
+            print(f"Using key file: {key_file}")
+        else:
+            print("Key file not found, trying default credentials")
+            firebase_admin.initialize_app()
+    return firestore.client()
+
+
+def load_local_questions():
+    # data 読み込み（ID が重複した場合は後から読み込んだ問題で上書きする）
+    return {q["id"]: q for q in ingest(source_files(data_dir))}
+
+
+def load_remote_hashes(coll):
+    # contentHash だけを射影して取得する（問題本文はダウンロードしない）
+    return {doc.id: (doc.to_dict() or {}).get("contentHash") for doc in coll.select(["contentHash"]).stream()}
+
+
+def diff_questions(local, remote):
+    upserts = []
+    for doc_id, q in local.items():
+        digest = content_hash(q)
+        if remote.get(doc_id) != digest:
+            # updatedAt はサーバーのポーリング監視（QUIZ_BANK_WATCH=poll）で差分検出に使う
+            upserts.append((doc_id, dict(q, contentHash=digest, updatedAt=firestore.SERVER_TIMESTAMP)))
+    removals = [doc_id for doc_id in remote if doc_id not in local]
+    return upserts, removals
+
+
+def combined_hash(hashes):
+    # ドキュメント ID と contentHash の組全体のハッシュ。meta/questions に記録しておき、
+    # 差分が無くても前回記録した内容と異なれば（バージョン更新前に中断した場合など）バージョンを更新する
+    h = hashlib.sha256()
+    for doc_id in sorted(hashes):
+        h.update(f"{doc_id}\0{hashes[doc_id]}\n".encode("utf-8"))
+    return h.hexdigest()
 
-# Firebase 初期化
-if not len(firebase_admin._apps):
-    if key_file.exists():
-        cred = credentials.Certificate(str(key_file))
-        firebase_admin.initialize_app(cred)
-        print(f"Using key file: {key_file}")
+
+def _commit_chunk(db, coll, ops):
+    batch = db.batch()
+    for kind, doc_id, data in ops:
+        if kind == "delete":
+            batch.delete(coll.document(doc_id))
+        else:
+            batch.set(coll.document(doc_id), data)
+    batch.commit()
+    return len(ops)
+
+
+def apply_diff(db, coll, upserts, removals, workers):
+    ops = [("set", doc_id, data) for doc_id, data in upserts]
+    ops += [("delete", doc_id, None) for doc_id in removals]
+    chunks = [ops[i:i + BATCH_LIMIT] for i in range(0, len(ops), BATCH_LIMIT)]
+    written = 0
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = [pool.submit(_commit_chunk, db, coll, chunk) for chunk in chunks]
+        for future in as_completed(futures):
+            try:
+                written += future.result()
+            except Exception as e:
+                errors.append(e)
+    return written, errors
+
+
+def import_questions(db, workers=8, dry_run=False, keep_removed=False):
+    coll = db.collection("questions")
+    local = load_local_questions()
+    remote = load_remote_hashes(coll)
+    upserts, removals = diff_questions(local, remote)
+    if keep_removed:
+        removals = []
+    print(
+        f"local={len(local)} remote={len(remote)} "
+        f"upsert={len(upserts)} delete={len(removals)} unchanged={len(local) - len(upserts)}"
+    )
+    if dry_run:
+        return 0
+
+    # 書き込み後の questions の内容
+    final = dict(remote)
+    for doc_id, data in upserts:
+        final[doc_id] = data["contentHash"]
+    for doc_id in removals:
+        final.pop(doc_id, None)
+    digest = combined_hash(final)
+    meta_ref = db.collection("meta").document("questions")
+    meta = meta_ref.get()
+    recorded = (meta.to_dict() or {}).get("contentHash") if meta.exists else None
+    if not (upserts or removals) and recorded == digest:
+        return 0
+
+    written = 0
+    if upserts or removals:
+        written, errors = apply_diff(db, coll, upserts, removals, workers)
+        if errors:
+            raise RuntimeError(
+                f"{len(errors)} batch(es) failed after {written} writes; re-run to resume: {errors[0]}"
+            )
     else:
-        print("Key file not found, trying default credentials")
-        firebase_admin.initialize_app()
-
-db = firestore.client()
-
-# data 読み込み
-data_dir = Path(__file__).parent.parent / "data"
-all_questions = []
-
-for json_file in data_dir.glob("*.json"):
-    if json_file.name == "firestore-schema.json":
-        continue
-    
-    try:
-        data = json.loads(json_file.read_text(encoding="utf-8"))
-        if not isinstance(data, list):
-            continue
-        for i, item in enumerate(data):
-            options = item.get("options") or item.get("choices") or []
-            raw_answer = item.get("answer")
-            
-            if isinstance(raw_answer, str):
-                try:
-                    answer_idx = options.index(raw_answer)
-                except ValueError:
-                    answer_idx = 0
-            else:
-                answer_idx = max(0, int(raw_answer or 0) - 1)
-                
-            item_id = str(item.get("id") or f"{json_file.stem}_{i+1}")
-            category = item.get("category") or ("ITパスポート" if "passpo" in json_file.name else "基本情報")
-            
-            all_questions.append({
-                "id": item_id,
-                "category": category,
-                "question": item.get("question") or "",
-                "options": options,
-                "answer": answer_idx,
-                "explanation": item.get("explanation")
-            })
-    except Exception as e:
-        print(f"Error reading {json_file}: {e}")
-
-# 既存 questions クリア＆新規追加
-batch = db.batch()
-coll = db.collection("questions")
-
-# 既存ドキュメントを削除
-for doc in coll.stream():
-    batch.delete(doc.reference)
-
-# 新しい問題を追加
-for q in all_questions:
-    doc_id = q["id"]
-    batch.set(coll.document(doc_id), q)
-
-batch.commit()
-print(f"Imported {len(all_questions)} questions to Firestore")
\ No newline at end of file
+        print("questions differ from the last recorded import; updating version")
+
+    # サーバー側のバンクキャッシュを無効化するためバージョンを更新
+    meta_ref.set(
+        {"version": datetime.now(timezone.utc).isoformat(), "count": len(final), "contentHash": digest}
+    )
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="data/*.json を Firestore の questions に差分インポートする")
+    parser.add_argument("--dry-run", action="store_true", help="差分を表示するだけで書き込まない")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("QUIZ_IMPORT_WORKERS", "8")))
+    parser.add_argument("--keep-removed", action="store_true", help="ローカルに無いドキュメントを削除しない")
+    args = parser.parse_args()
+
+    written = import_questions(get_client(), args.workers, args.dry_run, args.keep_removed)
+    print(f"Imported {written} changes to Firestore")
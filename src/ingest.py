@@ -0,0 +1,256 @@
+# 問題データの取り込みパイプライン
+#
+#   read → normalize → validate → dedupe → emit
+#
+# 各段はジェネレータで、ソースファイルを丸ごと読み込まずに 1 問ずつ処理する。
+# サーバー（main._load_questions_from_file）、import_questions.py、merge_script.py で共通に使う。
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger("quiz.ingest")
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+DATA_DIR = BASE_DIR / "data"
+SCHEMA_FILE = DATA_DIR / "firestore-schema.json"
+# SQLite・スピルファイルなどの書き込み先。BASE_DIR は main で静的ファイルとして公開するため、その外に置く
+STATE_DIR = Path(
+    os.getenv("QUIZ_STATE_DIR")
+    or Path(os.getenv("XDG_STATE_HOME") or Path.home() / ".local" / "state") / "quiz"
+)
+
+SOURCE_PATTERNS = ("*.json", "*.jsonl", "*.ndjson")
+READ_CHUNK_SIZE = 1 << 16
+
+# (ソース, 項目番号, 例外) を受け取る。項目番号が None の場合はファイル全体の読み込みエラー
+InvalidHandler = Callable[[str, Optional[int], Exception], None]
+
+
+def _log_invalid(source: str, index: Optional[int], error: Exception) -> None:
+    if index is None:
+        logger.warning("ingest: could not read %s: %s", source, error)
+    else:
+        logger.warning("ingest: skip invalid item %d in %s: %s", index, source, error)
+
+
+def source_files(data_dir: Path = DATA_DIR) -> List[Path]:
+    files = set()
+    for pattern in SOURCE_PATTERNS:
+        files.update(data_dir.glob(pattern))
+    return sorted(f for f in files if f.name != SCHEMA_FILE.name)
+
+
+def _iter_json_array(f, chunk_size: int = READ_CHUNK_SIZE) -> Iterator:
+    decoder = json.JSONDecoder()
+    buf, pos, eof = "", 0, False
+
+    def _more() -> None:
+        nonlocal buf, pos, eof
+        data = f.read(chunk_size)
+        eof = not data
+        buf, pos = buf[pos:] + data, 0
+
+    def _skip_ws() -> None:
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buf) or eof:
+                return
+            _more()
+
+    _skip_ws()
+    if pos >= len(buf) or buf[pos] != "[":
+        raise ValueError("top-level value is not an array")
+    pos += 1
+    first = True
+    while True:
+        _skip_ws()
+        if pos >= len(buf):
+            raise ValueError("unexpected end of file")
+        if buf[pos] == "]":
+            return
+        if not first:
+            if buf[pos] != ",":
+                raise ValueError(f"expected ',' at offset {pos}")
+            pos += 1
+            _skip_ws()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+                # 数値などがチャンク境界で切れている可能性があるため、バッファ末尾なら続きを読む
+                if end == len(buf) and not eof:
+                    raise ValueError("value may be truncated")
+                break
+            except ValueError:
+                if eof:
+                    raise
+                _more()
+        pos = end
+        first = False
+        yield value
+
+
+def read_items(
+    files: Iterable[Path], on_invalid: InvalidHandler = _log_invalid
+) -> Iterator[Tuple[Path, int, object]]:
+    for path in files:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                if path.suffix in (".jsonl", ".ndjson"):
+                    for i, line in enumerate(f):
+                        if not line.strip():
+                            continue
+                        try:
+                            item = json.loads(line)
+                        except ValueError as e:
+                            on_invalid(path.name, i, e)
+                            continue
+                        yield path, i, item
+                else:
+                    for i, item in enumerate(_iter_json_array(f)):
+                        yield path, i, item
+        except Exception as e:
+            on_invalid(path.name, None, e)
+
+
+def normalize_item(item: Dict, source: Path, index: int) -> Dict:
+    options = item.get("options") or item.get("choices") or []
+    raw_answer = item.get("answer")
+
+    if isinstance(raw_answer, str):
+        try:
+            answer_idx = options.index(raw_answer)
+        except ValueError:
+            logger.warning("ingest: answer not found in options for item %d in %s", index, source.name)
+            answer_idx = 0
+    else:
+        answer_idx = max(0, int(raw_answer or 0) - 1)
+    # main.QuestionBank.answer_col は int16（array("h")）
+    if answer_idx > 0x7FFF:
+        raise ValueError(f"answer out of range: {raw_answer}")
+
+    item_id = str(item.get("id") or f"{source.stem}_{index+1}")
+    category = item.get("category") or ("ITパスポート" if "passpo" in source.name else "基本情報")
+
+    return {
+        "id": item_id,
+        "category": category,
+        "question": item.get("question") or "",
+        "options": options,
+        "answer": answer_idx,
+        "explanation": item.get("explanation"),
+    }
+
+
+def normalize(
+    items: Iterable[Tuple[Path, int, object]], on_invalid: InvalidHandler = _log_invalid
+) -> Iterator[Tuple[Path, int, Dict]]:
+    for source, index, item in items:
+        try:
+            yield source, index, normalize_item(item, source, index)
+        except Exception as e:
+            on_invalid(source.name, index, e)
+
+
+def load_schema(schema_file: Path = SCHEMA_FILE) -> Optional[Dict]:
+    try:
+        schema = json.loads(schema_file.read_text(encoding="utf-8"))
+        return schema["collections"]["questions"]["schema"]
+    except Exception as e:
+        logger.warning("ingest: could not load schema %s: %s", schema_file, e)
+        return None
+
+
+_TYPES = {
+    "string": (str,),
+    "integer": (int,),
+    "number": (int, float),
+    "array": (list,),
+    "object": (dict,),
+    "boolean": (bool,),
+}
+
+
+def _schema_errors(value, rule: Dict, path: str) -> Iterator[str]:
+    # firestore-schema.json で使っているキーワードのみを扱う JSON Schema のサブセット
+    expected = rule.get("type")
+    if expected is not None:
+        names = expected if isinstance(expected, list) else [expected]
+        ok = any(
+            isinstance(value, _TYPES[name]) and not (name in ("integer", "number") and isinstance(value, bool))
+            for name in names
+        )
+        if not ok:
+            yield f"{path}: expected {expected}"
+            return
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if "minimum" in rule and value < rule["minimum"]:
+            yield f"{path}: {value} < {rule['minimum']}"
+        if "maximum" in rule and value > rule["maximum"]:
+            yield f"{path}: {value} > {rule['maximum']}"
+    if isinstance(value, list):
+        if "minItems" in rule and len(value) < rule["minItems"]:
+            yield f"{path}: fewer than {rule['minItems']} items"
+        if "maxItems" in rule and len(value) > rule["maxItems"]:
+            yield f"{path}: more than {rule['maxItems']} items"
+        if "items" in rule:
+            for i, element in enumerate(value):
+                yield from _schema_errors(element, rule["items"], f"{path}[{i}]")
+    if isinstance(value, dict):
+        required = rule.get("required", [])
+        for name in required:
+            if value.get(name) is None:
+                yield f"{path}.{name}: required"
+        for name, sub_rule in rule.get("properties", {}).items():
+            # 任意項目の None は未設定として扱う
+            if value.get(name) is not None:
+                yield from _schema_errors(value[name], sub_rule, f"{path}.{name}")
+
+
+def validate(
+    records: Iterable[Tuple[Path, int, Dict]],
+    schema: Optional[Dict],
+    on_invalid: InvalidHandler = _log_invalid,
+) -> Iterator[Tuple[Path, int, Dict]]:
+    for source, index, record in records:
+        if schema is not None:
+            errors = list(_schema_errors(record, schema, "question"))
+            if errors:
+                on_invalid(source.name, index, ValueError("; ".join(errors)))
+                continue
+        yield source, index, record
+
+
+def content_hash(record: Dict) -> str:
+    canonical = json.dumps(record, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def dedupe(records: Iterable[Tuple[Path, int, Dict]]) -> Iterator[Tuple[Path, int, Dict]]:
+    seen = set()
+    for source, index, record in records:
+        digest = content_hash(record)
+        if digest in seen:
+            logger.info("ingest: skip duplicate item %d in %s (id=%s)", index, source.name, record["id"])
+            continue
+        seen.add(digest)
+        yield source, index, record
+
+
+def ingest(
+    files: Optional[Iterable[Path]] = None,
+    schema_file: Optional[Path] = SCHEMA_FILE,
+    on_invalid: InvalidHandler = _log_invalid,
+) -> Iterator[Dict]:
+    if files is None:
+        files = source_files()
+    schema = load_schema(schema_file) if schema_file is not None else None
+    items = read_items(files, on_invalid)
+    stages = dedupe(validate(normalize(items, on_invalid), schema, on_invalid))
+    for _, _, record in stages:
+        yield record
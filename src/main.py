@@ -1,33 +1,128 @@
-from datetime import datetime, timedelta, timezone
-from typing import List, Optional, Dict
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional
+from array import array
 from pathlib import Path
+import asyncio
+import bisect
+import gzip
+import hashlib
+import heapq
+import inspect
+import itertools
 import json
 import random
+import secrets
 import os
 import logging
+import sys
+import threading
+import time
 
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+
+from answer_log import AnswerLog
+from bank_format import read_bank
+from ingest import STATE_DIR, ingest, source_files
+from metrics import MetricsMiddleware, record_db_op, render_metrics
+from shared_bank import SharedBank, encode_version
+from sampling import FenwickSampler, balanced_counts, sample_union
+from sm2 import next_review_at, replay_schedules, review_weight, update_schedule
+from sqlite_store import SqliteStore
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 import firebase_admin
-from firebase_admin import firestore, credentials
+from firebase_admin import firestore, firestore_async, credentials
 
 
 logger = logging.getLogger("quiz.app")
 
 
-app = FastAPI()
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    refresh_questions(force=True)
+    watcher = start_bank_watcher()
+    answer_log = start_answer_log()
+    yield
+    if watcher is not None:
+        watcher.stop()
+        if _shared_bank is not None:
+            _shared_bank.release_leader()
+    if answer_log is not None:
+        stop_answer_log()
+
+
+app = FastAPI(lifespan=_lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Next-Cursor"],
 )
+app.add_middleware(MetricsMiddleware)
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 DATA_DIR = BASE_DIR / "data"
+BANK_FILE = Path(os.getenv("QUIZ_BANK_FILE") or DATA_DIR / "questions.bank")
+
+FIRESTORE_BATCH_LIMIT = 500
+
+USER_STATE_CACHE_SIZE = int(os.getenv("QUIZ_USER_STATE_CACHE_SIZE", "1024"))
+USER_STATE_TTL_SECONDS = float(os.getenv("QUIZ_USER_STATE_TTL_SECONDS", "300"))
+# 重み付き出題の木を作り直すまでの秒数（期限超過の重みは時間とともに増えるため）
+SAMPLER_MAX_AGE_SECONDS = float(os.getenv("QUIZ_SAMPLER_MAX_AGE_SECONDS", "600"))
+
+DB_RETRY_SECONDS = float(os.getenv("QUIZ_DB_RETRY_SECONDS", "30"))
+# 1 より大きい場合、user_stats の加算を user_stats/{userId}/shards/{n} に分散する
+STATS_SHARDS = int(os.getenv("QUIZ_STATS_SHARDS", "1"))
+FIRESTORE_ASYNC = os.getenv("QUIZ_FIRESTORE_ASYNC", "0").lower() in ("1", "true", "yes")
+# firestore: Firestore のみ（接続できなければファイルのみで動作） / sqlite: SQLite のみ /
+# auto: Firestore に接続できなければ SQLite / none: 永続化しない
+STORE = os.getenv("QUIZ_STORE", "firestore").lower()
+SQLITE_PATH = Path(os.getenv("QUIZ_SQLITE_PATH") or STATE_DIR / "quiz.sqlite3")
+# Firestore 使用時、answers への追加をバックグラウンドでまとめて書き込む（answer_log.py）
+ANSWER_LOG = os.getenv("QUIZ_ANSWER_LOG", "1").lower() in ("1", "true", "yes")
+ANSWER_LOG_DIR = Path(os.getenv("QUIZ_ANSWER_LOG_DIR") or STATE_DIR / "answer_log")
+ANSWER_LOG_BATCH_SIZE = int(os.getenv("QUIZ_ANSWER_LOG_BATCH_SIZE", "200"))
+ANSWER_LOG_FLUSH_SECONDS = float(os.getenv("QUIZ_ANSWER_LOG_FLUSH_SECONDS", "1"))
+ANSWER_LOG_FSYNC = os.getenv("QUIZ_ANSWER_LOG_FSYNC", "0").lower() in ("1", "true", "yes")
+
+EXPORT_CHUNK_SIZE = 200
+
+# /api/v1/sessions のセッションはプロセス内に保持する（複数ワーカーではスティッキーな振り分けが必要）
+SESSION_CACHE_SIZE = int(os.getenv("QUIZ_SESSION_CACHE_SIZE", "10000"))
+SESSION_TTL_SECONDS = float(os.getenv("QUIZ_SESSION_TTL_SECONDS", "3600"))
+# 出題キューに先読みしておくページ数
+SESSION_PREFETCH_PAGES = int(os.getenv("QUIZ_SESSION_PREFETCH_PAGES", "2"))
+
+BANK_TTL_SECONDS = float(os.getenv("QUIZ_BANK_TTL_SECONDS", "60"))
+BANK_VERSION_COLLECTION = os.getenv("QUIZ_BANK_VERSION_COLLECTION", "meta")
+BANK_VERSION_DOC = os.getenv("QUIZ_BANK_VERSION_DOC", "questions")
+# snapshot: on_snapshot リスナー / poll: updatedAt の差分ポーリング（エミュレータ向け） / off: TTL のみ
+BANK_WATCH = os.getenv("QUIZ_BANK_WATCH", "snapshot").lower()
+BANK_POLL_SECONDS = float(os.getenv("QUIZ_BANK_POLL_SECONDS", "5"))
+BANK_POLL_SWEEP_EVERY = int(os.getenv("QUIZ_BANK_POLL_SWEEP_EVERY", "12"))
+# 複数ワーカーで 1 つのバンクファイルを mmap して共有する（shared_bank.py）
+SHARED_BANK = os.getenv("QUIZ_SHARED_BANK", "0").lower() in ("1", "true", "yes")
+SHARED_BANK_DIR = Path(
+    os.getenv("QUIZ_SHARED_BANK_DIR")
+    or (
+        Path("/dev/shm") / f"quiz-bank-{hashlib.sha1(str(BASE_DIR).encode()).hexdigest()[:8]}"
+        if Path("/dev/shm").is_dir()
+        else STATE_DIR / "shared_bank"
+    )
+)
 
 
 class Question(BaseModel):
@@ -91,12 +186,641 @@ class SessionResultsResponse(BaseModel):
     correctCount: int
 
 
+class SessionCreateRequest(BaseModel):
+    userId: str
+    size: int = Field(30, ge=1, le=500)
+    pageSize: int = Field(10, ge=1, le=100)
+    wrongOnly: bool = False
+    avoidCorrect: bool = False
+    randomMode: bool = True
+    category: Optional[List[str]] = None
+    weighted: bool = False
+    balanceCategories: bool = False
+    seed: Optional[int] = None
+
+
+class SessionPageResponse(BaseModel):
+    sessionId: str
+    total: int
+    remaining: int
+    questions: List[Question]
+
+
+class SessionSubmitRequest(BaseModel):
+    results: List[SessionResultItem]
+
+
+def _question_record(
+    id: str,
+    category,
+    question,
+    options,
+    answer,
+    explanation,
+) -> Dict:
+    if not isinstance(category, str) or not isinstance(question, str):
+        raise ValueError("category and question must be strings")
+    if not isinstance(options, list) or not all(isinstance(o, str) for o in options):
+        raise ValueError("options must be a list of strings")
+    if explanation is not None and not isinstance(explanation, str):
+        raise ValueError("explanation must be a string")
+    answer = int(answer)
+    # QuestionBank.answer_col は int16（array("h")）
+    if not -0x8000 <= answer <= 0x7FFF:
+        raise ValueError(f"answer out of range: {answer}")
+    return {
+        "id": str(id),
+        "category": category,
+        "question": question,
+        "options": options,
+        "answer": answer,
+        "explanation": explanation,
+    }
+
+
+class QuestionBank:
+    # 列指向の問題バンク。テキストは UTF-8 の共有バッファに連結し、
+    # Question モデルはレスポンスに含める問題だけ都度生成する。
+    # 問題 pos のスロットは [問題文, 解説, 選択肢...] の順に slot_start[pos]〜slot_start[pos + 1]
+    def __init__(self, records: Iterable[Dict]):
+        self.ids: List[str] = []
+        self.category_names: List[str] = []
+        self.category_ids = array("H")
+        self.answer_col = array("h")
+        self.has_explanation = bytearray()
+        self.slot_start = array("I", [0])
+        self.text_offsets = array("Q", [0])
+        category_index: Dict[str, int] = {}
+        chunks: List[bytes] = []
+        text_len = 0
+
+        def _append_text(value: str) -> None:
+            nonlocal text_len
+            encoded = value.encode("utf-8")
+            chunks.append(encoded)
+            text_len += len(encoded)
+            self.text_offsets.append(text_len)
+
+        for record in records:
+            category = record["category"]
+            cat_id = category_index.get(category)
+            if cat_id is None:
+                cat_id = category_index[category] = len(self.category_names)
+                self.category_names.append(category)
+            explanation = record.get("explanation")
+            self.ids.append(sys.intern(record["id"]))
+            self.category_ids.append(cat_id)
+            self.answer_col.append(record["answer"])
+            self.has_explanation.append(0 if explanation is None else 1)
+            _append_text(record["question"])
+            _append_text(explanation or "")
+            for option in record["options"]:
+                _append_text(option)
+            self.slot_start.append(len(self.text_offsets) - 1)
+        self.text = b"".join(chunks)
+        self._build_indexes()
+
+    _COLUMNS = (
+        "ids",
+        "category_names",
+        "category_ids",
+        "answer_col",
+        "has_explanation",
+        "slot_start",
+        "text_offsets",
+        "text",
+    )
+
+    @classmethod
+    def from_columns(cls, columns: Dict) -> "QuestionBank":
+        # bank_format.read_bank の戻り値（mmap 上の memoryview）をコピーせずに使う
+        bank = cls.__new__(cls)
+        for name in cls._COLUMNS:
+            setattr(bank, name, columns[name])
+        bank._mmap = columns.get("mmap")
+        bank._build_indexes()
+        return bank
+
+    def columns(self) -> Dict:
+        return {name: getattr(self, name) for name in self._COLUMNS}
+
+    def _build_indexes(self) -> None:
+        # バンク単位のレスポンスキャッシュ（バンク差し替えで自動的に破棄される）
+        self.response_cache: Dict[str, "EncodedBody"] = {}
+        # 位置と ID の対応が同じバンク間で共有されるトークン（UserSchedule の再構築判定に使う）
+        self.layout = object()
+        self._overrides: Dict[int, Dict] = {}
+        self.index: Dict[str, int] = {}
+        self.duplicates: Dict[str, List[int]] = {}
+        self.category_index: Dict[str, int] = {name: i for i, name in enumerate(self.category_names)}
+        self.by_category: Dict[str, List[int]] = {name: [] for name in self.category_names}
+        for pos, qid in enumerate(self.ids):
+            self.by_category[self.category_names[self.category_ids[pos]]].append(pos)
+            # ID 重複時は先に読み込んだ問題を優先する（従来の線形探索と同じ挙動）
+            if qid in self.index:
+                self.duplicates.setdefault(qid, []).append(pos)
+            else:
+                self.index[qid] = pos
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, question_id: str) -> bool:
+        return question_id in self.index
+
+    def _slot(self, slot: int) -> str:
+        return str(self.text[self.text_offsets[slot]:self.text_offsets[slot + 1]], "utf-8")
+
+    def with_updates(self, changes: Dict[int, Dict]) -> "QuestionBank":
+        # ID とカテゴリが変わらない更新は列を作り直さず、差分レコードを重ねた新しいバンクを返す
+        bank = QuestionBank.__new__(QuestionBank)
+        bank.__dict__.update(self.__dict__)
+        bank.answer_col = array("h", self.answer_col)
+        for pos, record in changes.items():
+            bank.answer_col[pos] = record["answer"]
+        bank._overrides = {**self._overrides, **changes}
+        bank.response_cache = {}
+        return bank
+
+    def question(self, pos: int) -> Question:
+        record = self._overrides.get(pos)
+        if record is not None:
+            return Question.model_construct(**record)
+        start, end = self.slot_start[pos], self.slot_start[pos + 1]
+        return Question.model_construct(
+            id=self.ids[pos],
+            category=self.category_names[self.category_ids[pos]],
+            question=self._slot(start),
+            options=[self._slot(slot) for slot in range(start + 2, end)],
+            answer=self.answer_col[pos],
+            explanation=self._slot(start + 1) if self.has_explanation[pos] else None,
+        )
+
+    def materialize(self, positions: Iterable[int]) -> List[Question]:
+        return [self.question(pos) for pos in positions]
+
+    def positions(self, question_id: str) -> List[int]:
+        pos = self.index.get(question_id)
+        if pos is None:
+            return []
+        return [pos] + self.duplicates.get(question_id, [])
+
+    def get(self, question_id: str) -> Optional[Question]:
+        pos = self.index.get(question_id)
+        return None if pos is None else self.question(pos)
+
+    def category_lists(self, categories: Iterable[str]) -> List[List[int]]:
+        # 指定カテゴリ（重複・未知の名前は除く）の問題位置リスト。各リストは昇順
+        return [self.by_category[name] for name in dict.fromkeys(categories) if name in self.by_category]
+
+    def category_positions(self, categories: Iterable[str]) -> List[int]:
+        lists = self.category_lists(categories)
+        if len(lists) == 1:
+            return lists[0]
+        return list(heapq.merge(*lists))
+
+    def is_correct(self, question_id: str, choice: int) -> bool:
+        pos = self.index.get(question_id)
+        return pos is not None and self.answer_col[pos] == choice
+
+
+_BUCKETS = ("due", "hard", "new", "others")
+
+
+def _take_positions(lists: List[List[int]], count: int, shuffle: bool, rng=random) -> List[int]:
+    # 昇順リストの和集合から、連結せずに先頭 count 件（位置順）またはランダムに count 件を取る
+    lists = [positions for positions in lists if positions]
+    if not lists:
+        return []
+    if len(lists) == 1:
+        positions = lists[0]
+        return rng.sample(positions, count) if shuffle else positions[:count]
+    if not shuffle:
+        return list(itertools.islice(heapq.merge(*lists), count))
+    offsets = list(itertools.accumulate(len(positions) for positions in lists))
+    selected = []
+    for i in rng.sample(range(offsets[-1]), count):
+        j = bisect.bisect_right(offsets, i)
+        selected.append(lists[j][i - offsets[j - 1] if j else i])
+    return selected
+
+
+class UserSchedule:
+    def __init__(self, states: Dict[str, Dict]):
+        self.states = states
+        self._lock = threading.Lock()
+        self._bank: Optional[QuestionBank] = None
+        # バケットごとに問題位置の昇順リストを保持する（先頭 K 件・ランダム K 件とも O(K)）
+        self._buckets: Dict[str, List[int]] = {name: [] for name in _BUCKETS}
+        self._where: Dict[int, str] = {}
+        # カテゴリ ID ごとのバケット。カテゴリ指定で初めて選ぶときに作り、以降は _move で更新する
+        self._by_category: Optional[Dict[int, Dict[str, List[int]]]] = None
+        # 重み付き抽出用の木と作成時刻（(バケット名, カテゴリ ID or None) ごと）。
+        # バケットが変わったら捨て、状態の更新は重みに反映し、SAMPLER_MAX_AGE_SECONDS で作り直す
+        self._samplers: Dict[tuple, tuple] = {}
+        self._review_at: Dict[int, datetime] = {}
+        self._pending: List[tuple] = []
+
+    def _classify(self, pos: int, state: Optional[Dict], now: datetime) -> str:
+        if not state:
+            return "new"
+        next_review = state.get("nextReviewAt")
+        if isinstance(next_review, datetime):
+            if next_review <= now:
+                return "due"
+            self._review_at[pos] = next_review
+            heapq.heappush(self._pending, (next_review, pos))
+        return "hard" if int(state.get("repetitions", 0)) == 0 else "others"
+
+    def _rebuild(self, bank: QuestionBank, now: datetime) -> None:
+        self._bank = bank
+        self._buckets = {name: [] for name in _BUCKETS}
+        self._where = {}
+        self._by_category = None
+        self._samplers = {}
+        self._review_at = {}
+        self._pending = []
+        for pos, qid in enumerate(bank.ids):
+            name = self._classify(pos, self.states.get(qid), now)
+            self._buckets[name].append(pos)
+            self._where[pos] = name
+
+    def _move(self, pos: int, name: str) -> None:
+        old = self._where.get(pos)
+        if old == name:
+            return
+        if old is not None:
+            bucket = self._buckets[old]
+            del bucket[bisect.bisect_left(bucket, pos)]
+        bisect.insort(self._buckets[name], pos)
+        self._where[pos] = name
+        if self._samplers:
+            self._samplers = {}
+        if self._by_category is not None:
+            buckets = self._by_category[self._bank.category_ids[pos]]
+            if old is not None:
+                del buckets[old][bisect.bisect_left(buckets[old], pos)]
+            bisect.insort(buckets[name], pos)
+
+    def _category_buckets(self) -> Dict[int, Dict[str, List[int]]]:
+        if self._by_category is None:
+            by_category: Dict[int, Dict[str, List[int]]] = {}
+            category_ids = self._bank.category_ids
+            for name in _BUCKETS:
+                # 元のバケットが昇順なので、振り分けたリストも昇順になる
+                for pos in self._buckets[name]:
+                    cat = category_ids[pos]
+                    buckets = by_category.get(cat)
+                    if buckets is None:
+                        buckets = by_category[cat] = {n: [] for n in _BUCKETS}
+                    buckets[name].append(pos)
+            self._by_category = by_category
+        return self._by_category
+
+    def _sampler(self, name: str, cat: Optional[int], bucket: List[int], now: datetime) -> FenwickSampler:
+        key = (name, cat)
+        cached = self._samplers.get(key)
+        if cached is not None and (now - cached[1]).total_seconds() <= SAMPLER_MAX_AGE_SECONDS:
+            return cached[0]
+        ids = self._bank.ids
+        sampler = FenwickSampler([review_weight(self.states.get(ids[pos]), now) for pos in bucket])
+        self._samplers[key] = (sampler, now)
+        return sampler
+
+    def _update_weight(self, pos: int, state: Dict, now: datetime) -> None:
+        # バケットが変わらなかった位置の重みを、キャッシュ済みの木に反映する
+        name = self._where[pos]
+        cat = self._bank.category_ids[pos]
+        weight = review_weight(state, now)
+        for key in ((name, None), (name, cat)):
+            cached = self._samplers.get(key)
+            if cached is not None:
+                bucket = self._buckets[name] if key[1] is None else self._by_category[cat][name]
+                cached[0].update(bisect.bisect_left(bucket, pos), weight)
+
+    def _take_weighted(self, name: str, sources: List[tuple], count: int, now: datetime, rng) -> List[int]:
+        samplers = [self._sampler(name, cat, bucket, now) for cat, bucket in sources]
+        if len(samplers) == 1:
+            bucket = sources[0][1]
+            return [bucket[i] for i in samplers[0].sample(count, rng)]
+        return [sources[j][1][i] for j, i in sample_union(samplers, count, rng)]
+
+    def _take_balanced(
+        self, name: str, sources: List[tuple], count: int, shuffle: bool, weighted: bool, now: datetime, rng
+    ) -> List[int]:
+        # カテゴリごとにできるだけ同じ件数を割り当て、各カテゴリの中で引く
+        selected: List[int] = []
+        for (cat, bucket), take in zip(sources, balanced_counts([len(b) for _, b in sources], count, rng)):
+            if not take:
+                continue
+            if weighted:
+                selected += self._take_weighted(name, [(cat, bucket)], take, now, rng)
+            else:
+                selected += _take_positions([bucket], take, shuffle, rng)
+        if shuffle:
+            rng.shuffle(selected)
+        else:
+            selected.sort()
+        return selected
+
+    def _promote(self, now: datetime) -> None:
+        while self._pending and self._pending[0][0] <= now:
+            review_at, pos = heapq.heappop(self._pending)
+            # 状態更新で古くなったエントリは読み捨てる
+            if self._review_at.get(pos) != review_at:
+                continue
+            del self._review_at[pos]
+            self._move(pos, "due")
+
+    def apply(self, question_id: str, state: Dict) -> None:
+        with self._lock:
+            self.states[question_id] = state
+            if self._bank is None:
+                return
+            now = datetime.now(timezone.utc)
+            for pos in self._bank.positions(question_id):
+                self._review_at.pop(pos, None)
+                self._move(pos, self._classify(pos, state, now))
+                if self._samplers:
+                    self._update_weight(pos, state, now)
+
+    def select(
+        self,
+        bank: QuestionBank,
+        limit: int,
+        wrong_only: bool,
+        avoid_correct: bool,
+        random_mode: bool,
+        now: datetime,
+        categories: Optional[List[str]] = None,
+        weighted: bool = False,
+        balance: bool = False,
+        rng=random,
+    ) -> List[Question]:
+        return bank.materialize(
+            self.select_positions(
+                bank,
+                limit,
+                wrong_only,
+                avoid_correct,
+                random_mode,
+                now,
+                categories=categories,
+                weighted=weighted,
+                balance=balance,
+                rng=rng,
+            )
+        )
+
+    def select_positions(
+        self,
+        bank: QuestionBank,
+        limit: int,
+        wrong_only: bool,
+        avoid_correct: bool,
+        random_mode: bool,
+        now: datetime,
+        exclude: Optional[set] = None,
+        categories: Optional[List[str]] = None,
+        weighted: bool = False,
+        balance: bool = False,
+        rng=random,
+    ) -> List[int]:
+        # weighted: review_weight に比例して引く / balance: カテゴリ間で件数を均等にする
+        # rng: random.Random(seed) を渡すと結果を再現できる
+        with self._lock:
+            if self._bank is None or self._bank.layout is not bank.layout:
+                self._rebuild(bank, now)
+            self._bank = bank
+            self._promote(now)
+            if wrong_only:
+                order = ("hard", "due", "new", "others")
+            elif avoid_correct:
+                order = ("due", "hard", "new", "others")
+            else:
+                order = ("due", "new", "others", "hard")
+            shuffle = random_mode or wrong_only or avoid_correct or weighted
+            if categories is None and not balance:
+                sources = {name: [(None, self._buckets[name])] for name in order}
+            else:
+                by_category = self._category_buckets()
+                if categories is None:
+                    cat_ids = list(by_category)
+                else:
+                    cat_ids = [
+                        bank.category_index[c] for c in dict.fromkeys(categories) if c in bank.category_index
+                    ]
+                sources = {
+                    name: [(c, by_category[c][name]) for c in cat_ids if c in by_category and by_category[c][name]]
+                    for name in order
+                }
+            # exclude に含まれる位置は最大 len(exclude) 件なので、その分だけ多めに取って除く
+            extra = len(exclude) if exclude else 0
+            selected: List[int] = []
+            for name in order:
+                entries = sources[name]
+                size = sum(len(bucket) for _, bucket in entries)
+                take = min(limit - len(selected), size)
+                if take <= 0:
+                    continue
+                count = min(take + extra, size)
+                if balance:
+                    positions = self._take_balanced(name, entries, count, shuffle, weighted, now, rng)
+                elif weighted:
+                    positions = self._take_weighted(name, entries, count, now, rng)
+                else:
+                    positions = _take_positions([bucket for _, bucket in entries], count, shuffle, rng)
+                if extra:
+                    positions = [pos for pos in positions if pos not in exclude][:take]
+                selected.extend(positions)
+            return selected
+
+    def counts(self) -> Dict[str, int]:
+        return {name: len(bucket) for name, bucket in self._buckets.items()}
+
+
+class UserStateCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, tuple[float, UserSchedule]]" = OrderedDict()
+        # 読み込み中のユーザーごとの (読み込み数, 書き込み版)。読み込み中に書き込みがあれば版が進む
+        self._loading: Dict[str, tuple] = {}
+
+    def get(self, user_id: str) -> Optional[UserSchedule]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            loaded_at, schedule = entry
+            if time.monotonic() - loaded_at > self.ttl:
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return schedule
+
+    def _put(self, user_id: str, schedule: UserSchedule) -> None:
+        # _lock の中で呼ぶ
+        if self.maxsize <= 0:
+            return
+        self._entries[user_id] = (time.monotonic(), schedule)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def begin_load(self, user_id: str) -> int:
+        # 未キャッシュのユーザーを読み込む前に呼び、戻り値の版を end_load() に渡す
+        with self._lock:
+            count, version = self._loading.get(user_id, (0, 0))
+            self._loading[user_id] = (count + 1, version)
+            return version
+
+    def end_load(self, user_id: str, version: int, schedule: Optional[UserSchedule]) -> bool:
+        # 読み込み中に書き込みが無かった場合だけキャッシュする。False の場合は読み直す
+        with self._lock:
+            count, current = self._loading.pop(user_id)
+            if count > 1:
+                self._loading[user_id] = (count - 1, current)
+            if schedule is None or current != version:
+                return False
+            # ロックを離す前に入れる（直後の書き込みが update() で反映されるように）
+            self._put(user_id, schedule)
+            return True
+
+    def _written(self, user_id: str) -> None:
+        # _lock の中で呼ぶ
+        loading = self._loading.get(user_id)
+        if loading is not None:
+            self._loading[user_id] = (loading[0], loading[1] + 1)
+
+    def update(self, user_id: str, question_id: str, state: Dict) -> None:
+        # 未キャッシュのユーザーは次回読み込み時に Firestore から取得する
+        with self._lock:
+            self._written(user_id)
+            entry = self._entries.get(user_id)
+        if entry is not None:
+            entry[1].apply(question_id, state)
+
+    def invalidate(self, user_id: str) -> None:
+        with self._lock:
+            self._written(user_id)
+            self._entries.pop(user_id, None)
+
+
+class QuizSession:
+    # 出題済み ID と、先に計算しておいた出題キュー（問題位置）を持つ。
+    # ページはキューの先頭から切り出し、残りが 1 ページ分を下回ったら次のチャンクを
+    # バックグラウンドで計算する。チャンクはその時点の学習状態から選ぶため、
+    # セッション中の回答も反映される
+    def __init__(
+        self,
+        user_id: str,
+        size: int,
+        page_size: int,
+        wrong_only: bool,
+        avoid_correct: bool,
+        random_mode: bool,
+        categories: Optional[List[str]] = None,
+        weighted: bool = False,
+        balance: bool = False,
+        seed: Optional[int] = None,
+    ):
+        self.id = secrets.token_urlsafe(16)
+        self.user_id = user_id
+        self.total = size
+        self.page_size = page_size
+        self.wrong_only = wrong_only
+        self.avoid_correct = avoid_correct
+        self.random_mode = random_mode
+        self.categories = categories
+        self.weighted = weighted
+        self.balance = balance
+        self.rng = random if seed is None else random.Random(seed)
+        self.served: List[str] = []
+        self.served_ids: set = set()
+        self.queue: List[int] = []
+        self.queue_layout = None
+        self.lock = asyncio.Lock()
+        self.prefetch: Optional[asyncio.Task] = None
+
+    @property
+    def remaining(self) -> int:
+        return self.total - len(self.served)
+
+
+class QuizSessionCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, tuple[float, QuizSession]]" = OrderedDict()
+
+    def get(self, session_id: str) -> Optional[QuizSession]:
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            touched_at, session = entry
+            if time.monotonic() - touched_at > self.ttl:
+                del self._entries[session_id]
+                return None
+            # 最終アクセスから TTL で失効させる
+            self._entries[session_id] = (time.monotonic(), session)
+            self._entries.move_to_end(session_id)
+            return session
+
+    def put(self, session: QuizSession) -> None:
+        with self._lock:
+            self._entries[session.id] = (time.monotonic(), session)
+            self._entries.move_to_end(session.id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, session_id: str) -> Optional[QuizSession]:
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+        return entry[1] if entry is not None else None
+
+
+_sessions = QuizSessionCache(SESSION_CACHE_SIZE, SESSION_TTL_SECONDS)
+# 永続化しない場合のセッション用（全問が new の状態）
+_anonymous_schedule = UserSchedule({})
+
 _db = None
+_db_failed_at: Optional[float] = None
+_async_db = None
+_sqlite_store: Optional[SqliteStore] = None
+_sqlite_lock = threading.Lock()
 _user_index: dict[str, int] = {}
 
+_user_states = UserStateCache(USER_STATE_CACHE_SIZE, USER_STATE_TTL_SECONDS)
+
+_bank_lock = threading.Lock()
+_bank: Optional[QuestionBank] = None
+_bank_version = None
+_bank_checked_at = 0.0
+_bank_watcher = None
+_shared_bank: Optional[SharedBank] = None
+_shared_bank_failed = False
+# 現在のバンクに対応する共有バンクの世代番号
+_bank_generation = 0
+_answer_log: Optional[AnswerLog] = None
+
+
+def _private_path(path: Path) -> Path:
+    # 公開ディレクトリ（BASE_DIR）の下は GET で読めてしまうため使わない
+    resolved = path.resolve()
+    if resolved == BASE_DIR or BASE_DIR in resolved.parents:
+        raise ValueError(f"{path} is inside the static root {BASE_DIR}")
+    return path
+
 
 def get_db():
-    global _db
+    global _db, _db_failed_at
+    # 初期化に失敗した直後はリクエストごとに再試行しない（認証情報の探索がブロックするため）
+    if _db is None and _db_failed_at is not None and time.monotonic() - _db_failed_at < DB_RETRY_SECONDS:
+        return None
     if _db is None:
         try:
             if not len(firebase_admin._apps):
@@ -115,405 +839,969 @@ def get_db():
         except Exception as e:
             logger.warning("Error initializing Firestore: %s", e)
             _db = None
+            _db_failed_at = time.monotonic()
     return _db
 
 
-def _load_questions_from_file() -> List[Question]:
-    result: List[Question] = []
-    if not DATA_DIR.exists():
-        return result
-
-    for json_file in DATA_DIR.glob("*.json"):
-        if json_file.name == "firestore-schema.json":
-            continue
-
+def get_io_db():
+    # リクエスト処理用のクライアント。QUIZ_FIRESTORE_ASYNC 有効時は非同期クライアントを返す
+    global _async_db
+    db = get_db()
+    if db is None or not FIRESTORE_ASYNC:
+        return db
+    if _async_db is None:
         try:
-            data = json.loads(json_file.read_text(encoding="utf-8"))
-            if not isinstance(data, list):
-                continue
-            for i, item in enumerate(data):
-                try:
-                    options = item.get("options") or item.get("choices") or []
-                    raw_answer = item.get("answer")
-
-                    if isinstance(raw_answer, str):
-                        try:
-                            answer_idx = options.index(raw_answer)
-                        except ValueError:
-                            answer_idx = 0
-                    else:
-                        answer_idx = max(0, int(raw_answer or 0) - 1)
-
-                    item_id = str(item.get("id") or f"{json_file.stem}_{i+1}")
-                    category = item.get("category") or ("ITパスポート" if "passpo" in json_file.name else "基本情報")
-
-                    result.append(
-                        Question(
-                            id=item_id,
-                            category=category,
-                            question=item.get("question") or "",
-                            options=options,
-                            answer=answer_idx,
-                            explanation=item.get("explanation"),
-                        )
-                    )
-                except Exception as e:
-                    logger.warning("load_questions_from_file: skip invalid item in %s: %s", json_file.name, e)
+            _async_db = firestore_async.client()
+            logger.info("Async Firestore client initialized")
         except Exception as e:
-            logger.warning("load_questions_from_file: could not read %s: %s", json_file.name, e)
+            logger.warning("Error initializing async Firestore: %s", e)
+            return db
+    return _async_db
+
 
+def _materialize(result):
+    if hasattr(result, "__next__"):
+        return list(result)
     return result
 
 
-def _load_questions_from_db(db) -> List[Question]:
+async def _db_io(db, fn, *args, **kwargs):
+    # 非同期クライアントはそのまま await し、同期クライアントはスレッドプールで実行する
+    start = time.perf_counter()
+    if db is not None and db is _async_db:
+        result = fn(*args, **kwargs)
+        if inspect.isawaitable(result):
+            result = await result
+        elif hasattr(result, "__aiter__"):
+            result = [item async for item in result]
+    else:
+        result = await run_in_threadpool(lambda: _materialize(fn(*args, **kwargs)))
+    record_db_op(fn, result, time.perf_counter() - start)
+    return result
+
+
+def _load_questions_from_file() -> List[Dict]:
+    if not DATA_DIR.exists():
+        return []
+    return list(ingest(source_files(DATA_DIR)))
+
+
+def _record_from_doc(doc) -> Dict:
+    data = doc.to_dict() or {}
+    return _question_record(
+        id=str(data.get("id") or doc.id),
+        category=data.get("category") or "",
+        question=data.get("question") or "",
+        options=list(data.get("options") or []),
+        answer=int(data.get("answer", 0)),
+        explanation=data.get("explanation"),
+    )
+
+
+def _load_questions_from_db(db) -> List[Dict]:
     try:
-        docs = list(db.collection("questions").stream())
+        query = db.collection("questions")
+        start = time.perf_counter()
+        docs = list(query.stream())
+        record_db_op(query.stream, docs, time.perf_counter() - start)
     except Exception as e:
         logger.warning("load_questions_from_db: error %s", e)
         return []
-    result: List[Question] = []
+    result: List[Dict] = []
     for d in docs:
-        data = d.to_dict() or {}
         try:
-            result.append(
-                Question(
-                    id=str(data.get("id") or d.id),
-                    category=data.get("category") or "",
-                    question=data.get("question") or "",
-                    options=list(data.get("options") or []),
-                    answer=int(data.get("answer", 0)),
-                    explanation=data.get("explanation"),
-                )
-            )
+            result.append(_record_from_doc(d))
         except Exception as e:
             logger.warning("load_questions_from_db: skip invalid doc %s", e)
     return result
 
 
-def load_questions() -> List[Question]:
-    db = get_db()
+def _load_bank_file() -> Optional[QuestionBank]:
+    # data/*.json より古いコンパイル済みバンクは使わない
+    try:
+        bank_mtime = BANK_FILE.stat().st_mtime_ns
+    except OSError:
+        return None
+    for source in source_files(DATA_DIR):
+        if source.stat().st_mtime_ns > bank_mtime:
+            logger.info("load_questions: %s is older than %s, ignoring", BANK_FILE.name, source.name)
+            return None
+    try:
+        return QuestionBank.from_columns(read_bank(BANK_FILE))
+    except Exception as e:
+        logger.warning("load_questions: could not map %s: %s", BANK_FILE, e)
+        return None
+
+
+def _read_bank() -> QuestionBank:
+    db = get_db() if STORE != "sqlite" else None
     if db is not None:
-        questions = _load_questions_from_db(db)
-        if questions:
-            logger.info("load_questions: loaded %d questions from Firestore", len(questions))
-            return questions
-    questions = _load_questions_from_file()
-    logger.info("load_questions: loaded %d questions from file", len(questions))
-    return questions
+        records = _load_questions_from_db(db)
+        if records:
+            logger.info("load_questions: loaded %d questions from Firestore", len(records))
+            return QuestionBank(records)
+    local = get_sqlite_store() if db is None else None
+    if local is not None:
+        records = local.load_questions()
+        if records:
+            logger.info("load_questions: loaded %d questions from %s", len(records), local.path.name)
+            return QuestionBank(records)
+    bank = _load_bank_file()
+    if bank is not None:
+        logger.info("load_questions: mapped %d questions from %s", len(bank), BANK_FILE.name)
+        return bank
+    records = _load_questions_from_file()
+    logger.info("load_questions: loaded %d questions from file", len(records))
+    return QuestionBank(records)
+
+
+def _file_bank_version():
+    if not DATA_DIR.exists():
+        return ()
+    version = []
+    for source in source_files(DATA_DIR):
+        try:
+            st = source.stat()
+        except OSError:
+            continue
+        version.append((source.name, st.st_mtime_ns, st.st_size))
+    try:
+        st = BANK_FILE.stat()
+        version.append((BANK_FILE.name, st.st_mtime_ns, st.st_size))
+    except OSError:
+        pass
+    return tuple(version)
 
 
-def _update_schedule(
-    repetitions: int, interval: int, ease: float, correct: bool, elapsed_ms: int
-):
-    if not correct:
-        quality = 1
+def _db_bank_version(db):
+    try:
+        ref = db.collection(BANK_VERSION_COLLECTION).document(BANK_VERSION_DOC)
+        start = time.perf_counter()
+        doc = ref.get()
+        record_db_op(ref.get, doc, time.perf_counter() - start)
+    except Exception as e:
+        logger.warning("bank_version: error reading version document %s", e)
+        return None
+    if not doc.exists:
+        return None
+    data = doc.to_dict() or {}
+    return data.get("version", data.get("updatedAt"))
+
+
+def _current_bank_version():
+    # None は「判定不能」: TTL 切れのたびに再読み込みする
+    db = get_db() if STORE != "sqlite" else None
+    db_version = None
+    if db is not None:
+        db_version = _db_bank_version(db)
+        if db_version is None:
+            return None
     else:
-        seconds = max(0, elapsed_ms) / 1000.0
-        if seconds <= 5:
-            quality = 5
-        elif seconds <= 12:
-            quality = 4
+        local = get_sqlite_store()
+        if local is not None:
+            db_version = local.bank_version()
+    return (db_version, _file_bank_version())
+
+
+def get_shared_bank() -> Optional[SharedBank]:
+    global _shared_bank, _shared_bank_failed
+    if not SHARED_BANK or _shared_bank_failed:
+        return _shared_bank
+    if _shared_bank is None:
+        try:
+            _shared_bank = SharedBank(_private_path(SHARED_BANK_DIR))
+            logger.info("shared_bank: using %s", SHARED_BANK_DIR)
+        except Exception as e:
+            logger.warning("shared_bank: could not open %s: %s", SHARED_BANK_DIR, e)
+            _shared_bank_failed = True
+    return _shared_bank
+
+
+def _bank_columns(bank: QuestionBank) -> Dict:
+    # 差分を重ねたバンクは列に畳み込んでから書き出す
+    if bank._overrides:
+        bank = QuestionBank(q.model_dump() for q in bank.materialize(range(len(bank))))
+    return bank.columns()
+
+
+def _bank_is_fresh() -> bool:
+    # 他のワーカーが新しい世代を公開していれば読み直す
+    shared = _shared_bank
+    if shared is not None and shared.generation() != _bank_generation:
+        return False
+    # リスナーが動いている間はリスナーがバンクを最新に保つ
+    if _bank_watcher is not None:
+        if _bank_watcher.active:
+            return True
+        if shared is not None:
+            # 止まったリスナーのワーカーは、他のワーカーと同じく TTL で確認する
+            shared.release_leader()
+    return time.monotonic() - _bank_checked_at < BANK_TTL_SECONDS
+
+
+def _refresh_shared(shared: SharedBank) -> QuestionBank:
+    # 確認と読み込みは 1 ワーカーだけが行い、他のワーカーは公開された世代を mmap する。
+    # _bank_lock を持った状態で呼ぶ
+    global _bank, _bank_version, _bank_checked_at, _bank_generation
+    with shared.locked():
+        generation, checked_at, version = shared.state()
+        trusted = generation and (
+            time.time() - checked_at < BANK_TTL_SECONDS or shared.leader_alive()
+        )
+        if not trusted:
+            current = encode_version(_current_bank_version())
+            if generation and current is not None and current == version:
+                shared.touch()
+            else:
+                bank = _read_bank()
+                generation = shared.publish(_bank_columns(bank), current)
+                version = current
+                logger.info(
+                    "refresh_questions: published generation=%d questions=%d", generation, len(bank)
+                )
+        if _bank is None or generation != _bank_generation:
+            _bank = QuestionBank.from_columns(shared.load(generation))
+            _bank_generation = generation
+            logger.info("refresh_questions: mapped generation=%d questions=%d", generation, len(_bank))
+    _bank_version, _bank_checked_at = version, time.monotonic()
+    return _bank
+
+
+def refresh_questions(force: bool = False) -> QuestionBank:
+    global _bank, _bank_version, _bank_checked_at
+    # 読み込み中に別リクエストが来た場合は古いバンクをそのまま返す
+    if not _bank_lock.acquire(blocking=_bank is None):
+        return _bank
+    try:
+        if not force and _bank is not None and _bank_is_fresh():
+            return _bank
+        shared = get_shared_bank()
+        if shared is not None:
+            try:
+                return _refresh_shared(shared)
+            except Exception as e:
+                logger.warning("refresh_questions: shared bank failed, loading locally: %s", e)
+        version = _current_bank_version()
+        if not force and _bank is not None and version is not None and version == _bank_version:
+            _bank_checked_at = time.monotonic()
+            return _bank
+        bank = _read_bank()
+        _bank, _bank_version, _bank_checked_at = bank, version, time.monotonic()
+        logger.info("refresh_questions: bank swapped questions=%d version=%s", len(bank), version)
+        return bank
+    finally:
+        _bank_lock.release()
+
+
+def _swap_bank(bank: QuestionBank) -> None:
+    global _bank, _bank_version, _bank_checked_at, _bank_generation
+    with _bank_lock:
+        _bank, _bank_version, _bank_checked_at = bank, None, time.monotonic()
+        shared = _shared_bank
+        if shared is not None:
+            # リスナーを動かすワーカーは自分のバンクを使い続け、他のワーカーに公開する
+            try:
+                _bank_generation = shared.publish(_bank_columns(bank), None)
+            except Exception as e:
+                logger.warning("bank_watcher: could not publish shared bank: %s", e)
+
+
+class BankWatcher:
+    def __init__(self, db, mode: str):
+        self.db = db
+        self.mode = mode
+        self.records: Dict[str, Dict] = {}
+        self.positions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._layout = None
+        self._watch = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._watermark: Optional[datetime] = None
+
+    @property
+    def active(self) -> bool:
+        if self.mode == "poll":
+            return self._thread is not None and self._thread.is_alive()
+        return self._watch is not None and self._watch.is_active
+
+    def start(self) -> "BankWatcher":
+        if self.mode == "poll":
+            self._thread = threading.Thread(target=self._poll_loop, name="bank-watcher", daemon=True)
+            self._thread.start()
         else:
-            quality = 3
-    ease = ease + (0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
-    if ease < 1.3:
-        ease = 1.3
-    if quality < 3:
-        repetitions = 0
-        interval = 1
-    else:
-        repetitions += 1
-        if repetitions == 1:
-            interval = 1
-        elif repetitions == 2:
-            interval = 6
+            self._watch = self.db.collection("questions").on_snapshot(self._on_snapshot)
+        logger.info("bank_watcher: started mode=%s", self.mode)
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+
+    def _collect(self, doc, upserts: Dict[str, Dict]) -> None:
+        try:
+            upserts[doc.id] = _record_from_doc(doc)
+        except Exception as e:
+            logger.warning("bank_watcher: skip invalid doc %s: %s", doc.id, e)
+
+    def _on_snapshot(self, docs, changes, read_time) -> None:
+        upserts: Dict[str, Dict] = {}
+        removed = set()
+        for change in changes:
+            if change.type.name == "REMOVED":
+                removed.add(change.document.id)
+            else:
+                self._collect(change.document, upserts)
+        self.apply(upserts, removed)
+
+    def _poll_loop(self) -> None:
+        coll = self.db.collection("questions")
+        polls = 0
+        while not self._stop.is_set():
+            try:
+                removed = set()
+                if self._watermark is None:
+                    docs = list(coll.stream())
+                else:
+                    docs = list(coll.where("updatedAt", ">", self._watermark).stream())
+                    # 削除は updatedAt では検出できないため、定期的に ID 一覧と突き合わせる
+                    if polls % BANK_POLL_SWEEP_EVERY == 0:
+                        removed = set(self.records) - {d.id for d in coll.select([]).stream()}
+                upserts: Dict[str, Dict] = {}
+                watermark = self._watermark or datetime.fromtimestamp(0, timezone.utc)
+                for doc in docs:
+                    self._collect(doc, upserts)
+                    updated_at = (doc.to_dict() or {}).get("updatedAt")
+                    if isinstance(updated_at, datetime) and updated_at > watermark:
+                        watermark = updated_at
+                self._watermark = watermark
+                self.apply(upserts, removed)
+            except Exception as e:
+                logger.warning("bank_watcher: poll failed: %s", e)
+            polls += 1
+            self._stop.wait(BANK_POLL_SECONDS)
+
+    def apply(self, upserts: Dict[str, Dict], removed) -> None:
+        if not upserts and not removed:
+            return
+        with self._lock:
+            structural = any(doc_id in self.records for doc_id in removed)
+            changes: Dict[int, Dict] = {}
+            for doc_id, record in upserts.items():
+                old = self.records.get(doc_id)
+                if old is None or old["id"] != record["id"] or old["category"] != record["category"]:
+                    structural = True
+                elif old != record:
+                    changes[self.positions[doc_id]] = record
+            for doc_id in removed:
+                self.records.pop(doc_id, None)
+            self.records.update(upserts)
+            if not self.records:
+                logger.warning("bank_watcher: questions collection is empty, keeping current bank")
+                return
+
+            bank = _bank
+            # 差分が溜まりすぎたら作り直して列に畳み込む
+            compact = bank is not None and len(bank._overrides) + len(changes) > max(64, len(self.records) // 10)
+            if structural or compact or bank is None or bank.layout is not self._layout:
+                self.positions = {doc_id: pos for pos, doc_id in enumerate(self.records)}
+                new_bank = QuestionBank(self.records.values())
+                self._layout = new_bank.layout
+            elif changes:
+                new_bank = bank.with_updates(changes)
+            else:
+                return
+            _swap_bank(new_bank)
+            logger.info(
+                "bank_watcher: applied upserts=%d removed=%d rebuilt=%s questions=%d",
+                len(upserts),
+                len(removed),
+                new_bank.layout is not bank.layout if bank is not None else True,
+                len(new_bank),
+            )
+
+
+def start_bank_watcher() -> Optional[BankWatcher]:
+    global _bank_watcher
+    if BANK_WATCH not in ("snapshot", "poll") or STORE == "sqlite":
+        return None
+    db = get_db()
+    if db is None:
+        return None
+    shared = get_shared_bank()
+    if shared is not None and not shared.acquire_leader():
+        # リスナーは 1 ワーカーだけが動かし、他のワーカーは公開された世代を使う
+        logger.info("bank_watcher: another worker is watching %s", SHARED_BANK_DIR)
+        return None
+    try:
+        _bank_watcher = BankWatcher(db, BANK_WATCH).start()
+    except Exception as e:
+        logger.warning("bank_watcher: could not start %s", e)
+        _bank_watcher = None
+        if shared is not None:
+            shared.release_leader()
+    return _bank_watcher
+
+
+def start_answer_log() -> Optional[AnswerLog]:
+    global _answer_log
+    if not ANSWER_LOG or STORE not in ("firestore", "auto"):
+        return None
+    db = get_db()
+    if db is None:
+        return None
+    try:
+        _answer_log = AnswerLog(
+            db,
+            _private_path(ANSWER_LOG_DIR),
+            ANSWER_LOG_BATCH_SIZE,
+            ANSWER_LOG_FLUSH_SECONDS,
+            ANSWER_LOG_FSYNC,
+        ).start()
+    except Exception as e:
+        logger.warning("answer_log: could not start %s", e)
+        _answer_log = None
+    return _answer_log
+
+
+def stop_answer_log() -> None:
+    global _answer_log
+    log, _answer_log = _answer_log, None
+    if log is not None:
+        log.close()
+
+
+def get_bank() -> QuestionBank:
+    bank = _bank
+    if bank is not None and _bank_is_fresh():
+        return bank
+    return refresh_questions()
+
+
+async def get_bank_async() -> QuestionBank:
+    bank = _bank
+    if bank is not None and _bank_is_fresh():
+        return bank
+    return await run_in_threadpool(refresh_questions)
+
+
+def load_questions() -> List[Question]:
+    bank = get_bank()
+    return bank.materialize(range(len(bank)))
+
+
+def _state_doc_id(user_id: str, question_id: str) -> str:
+    return f"{user_id}_{question_id}"
+
+
+def _schedule_fields(state: Optional[Dict]):
+    state = state or {}
+    return (
+        int(state.get("repetitions", 0)),
+        int(state.get("interval", 1)),
+        float(state.get("ease", 2.5)),
+    )
+
+
+async def _load_user_schedule(store, user_id: str) -> UserSchedule:
+    cached = _user_states.get(user_id)
+    if cached is not None:
+        return cached
+    # 読み込み中に回答が書き込まれた場合、読んだ状態は古いため 1 度だけ読み直す
+    for _ in range(2):
+        version = _user_states.begin_load(user_id)
+        schedule = None
+        try:
+            schedule = UserSchedule(await store.load_user_states(user_id))
+        finally:
+            fresh = _user_states.end_load(user_id, version, schedule)
+        if fresh:
+            break
+    return schedule
+
+
+def _stats_write_ref(db, user_id: str):
+    ref = db.collection("user_stats").document(user_id)
+    if STATS_SHARDS > 1:
+        return ref.collection("shards").document(str(random.randrange(STATS_SHARDS)))
+    return ref
+
+
+def _stats_increment(user_id: str, answers: int, correct: int, elapsed_ms: int, now: datetime) -> Dict:
+    return {
+        "userId": user_id,
+        "totalAnswers": firestore.Increment(answers),
+        "correctCount": firestore.Increment(correct),
+        "totalElapsedMs": firestore.Increment(elapsed_ms),
+        "lastAnsweredAt": now,
+    }
+
+
+def _aggregation_values(rows) -> Dict[str, float]:
+    values: Dict[str, float] = {}
+    for row in rows:
+        for result in row if isinstance(row, list) else [row]:
+            values[result.alias] = result.value
+    return values
+
+
+async def _commit_writes(db, writes) -> None:
+    # Firestore の WriteBatch は 1 回あたり 500 件まで
+    for start in range(0, len(writes), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for ref, data, merge in writes[start:start + FIRESTORE_BATCH_LIMIT]:
+            batch.set(ref, data, merge=merge)
+        await _db_io(db, batch.commit)
+
+
+# 学習状態・回答・統計の保存先。FirestoreStore と sqlite_store.SqliteStore が同じメソッドを持つ:
+#   load_user_states(user_id) -> {questionId: state}
+#   get_user_states(user_id, question_ids) -> {questionId: state}（存在するものだけ）
+#   record_answers(user_id, answers, states, now)  回答の追加・状態の上書き・統計の加算
+#   get_stats(user_id) -> (totalAnswers, correctCount)
+class FirestoreStore:
+    name = "firestore"
+
+    def __init__(self, db):
+        self.db = db
+
+    async def load_user_states(self, user_id: str) -> Dict[str, Dict]:
+        query = self.db.collection("user_question_state").where("userId", "==", user_id)
+        states: Dict[str, Dict] = {}
+        for doc in await _db_io(self.db, query.stream):
+            data = doc.to_dict() or {}
+            qid = data.get("questionId")
+            if qid:
+                states[qid] = data
+        return states
+
+    async def get_user_states(self, user_id: str, question_ids: List[str]) -> Dict[str, Dict]:
+        coll = self.db.collection("user_question_state")
+        refs = [coll.document(_state_doc_id(user_id, qid)) for qid in question_ids]
+        if len(refs) == 1:
+            snapshots = [await _db_io(self.db, refs[0].get)]
         else:
-            interval = int(interval * ease)
-    next_review = datetime.now(timezone.utc) + timedelta(days=interval)
-    return repetitions, interval, ease, next_review
+            snapshots = await _db_io(self.db, self.db.get_all, refs)
+        by_path = {snap.reference.path: snap for snap in snapshots}
+        states: Dict[str, Dict] = {}
+        for qid, ref in zip(question_ids, refs):
+            snap = by_path.get(ref.path)
+            if snap is not None and snap.exists:
+                states[qid] = snap.to_dict() or {}
+        return states
+
+    async def record_answers(
+        self, user_id: str, answers: List[Dict], states: Dict[str, Dict], now: datetime
+    ) -> None:
+        db = self.db
+        correct = sum(1 for a in answers if a["correct"])
+        elapsed = sum(max(0, int(a["elapsedMs"])) for a in answers)
+        stats = _stats_increment(user_id, len(answers), correct, elapsed, now)
+        state_coll = db.collection("user_question_state")
+        # 回答の記録はレスポンスに影響しないため、ログが動いていればそちらに渡す
+        log = _answer_log
+        if log is not None and await run_in_threadpool(log.append, answers):
+            answers = []
+        if len(answers) <= 1 and len(states) == 1:
+            # 1 件だけの回答はバッチを組まずに書き込みを並行して送る
+            (qid, state), = states.items()
+            writes = [
+                _db_io(db, state_coll.document(_state_doc_id(user_id, qid)).set, state, merge=True),
+                _db_io(db, _stats_write_ref(db, user_id).set, stats, merge=True),
+            ]
+            if answers:
+                writes.append(_db_io(db, db.collection("answers").add, answers[0]))
+            await asyncio.gather(*writes)
+            return
+        answers_coll = db.collection("answers")
+        writes = [(answers_coll.document(), answer, False) for answer in answers]
+        writes += [
+            (state_coll.document(_state_doc_id(user_id, qid)), state, True) for qid, state in states.items()
+        ]
+        writes.append((_stats_write_ref(db, user_id), stats, True))
+        await _commit_writes(db, writes)
+
+    async def get_stats(self, user_id: str):
+        db = self.db
+        stats_ref = db.collection("user_stats").document(user_id)
+        reads = [_db_io(db, stats_ref.get)]
+        if STATS_SHARDS > 1:
+            reads.append(_db_io(db, stats_ref.collection("shards").stream))
+        results = await asyncio.gather(*reads)
+        stats_docs = [results[0]] + (results[1] if len(results) > 1 else [])
+        found = [d.to_dict() or {} for d in stats_docs if d.exists]
+        if found:
+            total = sum(int(data.get("totalAnswers", 0)) for data in found)
+            correct = sum(int(data.get("correctCount", 0)) for data in found)
+            return total, correct
+        # user_stats が未作成の場合は集計クエリで数える（回答ドキュメント本体は取得しない）
+        answers = db.collection("answers").where("userId", "==", user_id)
+        total_rows, correct_rows = await asyncio.gather(
+            _db_io(db, answers.count(alias="total").get),
+            _db_io(db, answers.where("correct", "==", True).count(alias="correct").get),
+        )
+        total = int(_aggregation_values(total_rows).get("total", 0))
+        if total == 0:
+            return 0, 0
+        return total, int(_aggregation_values(correct_rows).get("correct", 0))
+
+
+def get_sqlite_store() -> Optional[SqliteStore]:
+    global _sqlite_store
+    if STORE not in ("sqlite", "auto"):
+        return None
+    with _sqlite_lock:
+        if _sqlite_store is None:
+            try:
+                _sqlite_store = SqliteStore(_private_path(SQLITE_PATH))
+                logger.info("SQLite store opened at %s", SQLITE_PATH)
+            except Exception as e:
+                logger.warning("Error opening SQLite store %s: %s", SQLITE_PATH, e)
+                return None
+    return _sqlite_store
+
+
+def _get_store():
+    # None の場合は永続化せずに動作する（出題は順番、統計は 0）
+    if STORE in ("firestore", "auto"):
+        db = get_io_db()
+        if db is not None:
+            return FirestoreStore(db)
+    return get_sqlite_store()
+
+
+def _store_pending() -> bool:
+    # クライアントの作成（認証情報の探索・SQLite のオープン）がまだ必要か
+    if STORE in ("firestore", "auto"):
+        if _db is None:
+            if _db_failed_at is None or time.monotonic() - _db_failed_at >= DB_RETRY_SECONDS:
+                return True
+        elif FIRESTORE_ASYNC and _async_db is None:
+            return True
+        else:
+            return False
+    return STORE in ("sqlite", "auto") and _sqlite_store is None
+
+
+async def get_store():
+    # 初期化はブロックするためスレッドプールで行う。初期化済み・再試行待ちの間はそのまま返す
+    if _store_pending():
+        return await run_in_threadpool(_get_store)
+    return _get_store()
 
 
 @app.get("/api/v1/questions/next", response_model=NextQuestionResponse)
-def get_next_question(
+async def get_next_question(
     userId: str = Query(...),
     wrongOnly: bool = Query(False),
     avoidCorrect: bool = Query(False),
     randomMode: bool = Query(False),
+    category: Optional[List[str]] = Query(None),
 ):
-    questions = load_questions()
-    if not questions:
+    bank = await get_bank_async()
+    if not len(bank):
         return NextQuestionResponse(question=None)
 
-    db = get_db()
+    store = await get_store()
     now = datetime.now(timezone.utc)
 
-    if db is None:
+    if store is None:
+        pool = bank.category_positions(category) if category else range(len(bank))
+        if not pool:
+            return NextQuestionResponse(question=None)
         idx = _user_index.get(userId, 0)
-        if idx >= len(questions):
+        if idx >= len(pool):
             idx = 0
-        q = questions[idx]
-        _user_index[userId] = (idx + 1) % len(questions)
-        return NextQuestionResponse(question=q)
+        _user_index[userId] = (idx + 1) % len(pool)
+        return NextQuestionResponse(question=bank.question(pool[idx]))
 
-    state_docs = list(
-        db.collection("user_question_state").where("userId", "==", userId).stream()
+    schedule = await _load_user_schedule(store, userId)
+    selected = schedule.select(
+        bank, 1, wrongOnly, avoidCorrect, randomMode, now, categories=category
     )
-    state_map: Dict[str, Dict] = {}
-    for doc in state_docs:
-        data = doc.to_dict() or {}
-        qid = data.get("questionId")
-        if qid:
-            state_map[qid] = data
-
-    due: List[Question] = []
-    hard: List[Question] = []
-    new: List[Question] = []
-    others: List[Question] = []
-
-    for q in questions:
-        s = state_map.get(q.id)
-        if not s:
-            new.append(q)
+    return NextQuestionResponse(question=selected[0] if selected else None)
+
+
+class EncodedBody:
+    def __init__(self, payload):
+        # Starlette の JSONResponse と同じ設定でエンコードする
+        identity = json.dumps(
+            payload, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+        ).encode("utf-8")
+        digest = hashlib.sha256(identity).hexdigest()[:32]
+        self.variants: Dict[str, tuple[bytes, str]] = {
+            "identity": (identity, f'"{digest}"'),
+            "gzip": (gzip.compress(identity, compresslevel=9, mtime=0), f'"{digest}-gzip"'),
+        }
+        if brotli is not None:
+            self.variants["br"] = (brotli.compress(identity), f'"{digest}-br"')
+        self.etags = {etag for _, etag in self.variants.values()}
+
+
+def _choose_encoding(accept_encoding: str, variants: Dict) -> str:
+    accepted = set()
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q=") and params[2:] in ("0", "0.0", "0.00", "0.000"):
             continue
-        repetitions = int(s.get("repetitions", 0))
-        next_review = s.get("nextReviewAt")
-        if isinstance(next_review, datetime) and next_review <= now:
-            due.append(q)
-        elif repetitions == 0:
-            hard.append(q)
-        else:
-            others.append(q)
+        accepted.add(name.strip().lower())
+    for encoding in ("br", "gzip"):
+        if encoding in variants and (encoding in accepted or "*" in accepted):
+            return encoding
+    return "identity"
+
+
+def _cached_json_response(request: Request, bank: QuestionBank, key: Optional[str], build) -> Response:
+    # key が None の場合はキャッシュせずにエンコードする
+    encoded = bank.response_cache.get(key) if key is not None else None
+    if encoded is None:
+        encoded = EncodedBody(build())
+        if key is not None:
+            bank.response_cache[key] = encoded
+    encoding = _choose_encoding(request.headers.get("accept-encoding", ""), encoded.variants)
+    body, etag = encoded.variants[encoding]
+    headers = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if "*" in tags or tags & encoded.etags:
+            return Response(status_code=304, headers=headers)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
 
-    candidates: List[Question] = []
 
-    if wrongOnly:
-        candidates = hard or due or new or others
-    elif due:
-        candidates = due
-    elif avoidCorrect:
-        candidates = hard or new or others or due
-    else:
-        candidates = new or due or others or hard
+@app.get("/api/v1/questions", response_model=list[Question])
+async def list_questions(request: Request, category: Optional[List[str]] = Query(None)):
+    bank = await get_bank_async()
+    if not category:
+        return _cached_json_response(
+            request,
+            bank,
+            "questions",
+            lambda: [q.model_dump() for q in bank.materialize(range(len(bank)))],
+        )
+    names = [name for name in dict.fromkeys(category) if name in bank.by_category]
+    # 組み合わせごとにキャッシュすると際限なく増えるため、単一カテゴリのみキャッシュする
+    key = f"questions:{names[0]}" if len(names) == 1 else None
+    return _cached_json_response(
+        request,
+        bank,
+        key,
+        lambda: [q.model_dump() for q in bank.materialize(bank.category_positions(names))],
+    )
 
-    if not candidates:
-        return NextQuestionResponse(question=None)
 
-    if randomMode or wrongOnly or avoidCorrect:
-        q = random.choice(candidates)
-    else:
-        q = candidates[0]
+@app.get("/api/v1/questions/export")
+async def export_questions(
+    category: Optional[List[str]] = Query(None),
+    cursor: Optional[str] = Query(None, min_length=1),
+    limit: Optional[int] = Query(None, ge=1),
+):
+    # NDJSON で 1 行 1 問を逐次送信する。cursor は直前のページの最後の問題 ID（X-Next-Cursor）。
+    # 位置はバンクの再構築で変わるため ID で受け渡し、その問題が無くなっていれば 409 を返す
+    bank = await get_bank_async()
+    positions = bank.category_positions(category) if category else range(len(bank))
+    start = 0
+    if cursor is not None:
+        cursor_pos = bank.index.get(cursor)
+        if cursor_pos is None:
+            raise HTTPException(status_code=409, detail="cursor is no longer valid")
+        start = bisect.bisect_right(positions, cursor_pos)
+    end = len(positions) if limit is None else min(len(positions), start + limit)
+
+    def _is_cursor(i: int) -> bool:
+        # ID 重複時は index が指す位置でしかページを区切れない
+        pos = positions[i - 1]
+        return bank.index[bank.ids[pos]] == pos
+
+    if end < len(positions) and not _is_cursor(end):
+        shorter = end
+        while shorter > start + 1 and not _is_cursor(shorter):
+            shorter -= 1
+        if _is_cursor(shorter):
+            end = shorter
+        else:
+            while end < len(positions) and not _is_cursor(end):
+                end += 1
+    page = positions[start:end]
+    headers = {}
+    if end < len(positions):
+        headers["X-Next-Cursor"] = bank.ids[positions[end - 1]]
+
+    def _lines():
+        for i in range(0, len(page), EXPORT_CHUNK_SIZE):
+            chunk = bank.materialize(page[i:i + EXPORT_CHUNK_SIZE])
+            yield "".join(
+                json.dumps(q.model_dump(), ensure_ascii=False) + "\n" for q in chunk
+            ).encode("utf-8")
 
-    return NextQuestionResponse(question=q)
+    logger.info(
+        "export_questions: category=%s cursor=%s limit=%s count=%d",
+        category,
+        cursor,
+        limit,
+        len(page),
+    )
+    return StreamingResponse(_lines(), media_type="application/x-ndjson", headers=headers)
 
 
-@app.get("/api/v1/questions", response_model=list[Question])
-def list_questions():
-    return load_questions()
+def _build_meta(bank: QuestionBank) -> Dict:
+    categories = [
+        CategoryMeta(name=name, count=len(ids)) for name, ids in sorted(bank.by_category.items())
+    ]
+    return MetaResponse(totalQuestions=len(bank), categories=categories).model_dump()
 
 
 @app.get("/api/v1/meta", response_model=MetaResponse)
-def get_meta():
-    questions = load_questions()
-    total = len(questions)
-    by_cat: Dict[str, int] = {}
-    for q in questions:
-        by_cat[q.category] = by_cat.get(q.category, 0) + 1
-    categories = [
-        CategoryMeta(name=name, count=count) for name, count in sorted(by_cat.items())
-    ]
-    response = MetaResponse(totalQuestions=total, categories=categories)
-    logger.info("Meta requested: total_questions=%d, categories=%d", total, len(categories))
-    return response
+async def get_meta(request: Request):
+    bank = await get_bank_async()
+    logger.info("Meta requested: total_questions=%d, categories=%d", len(bank), len(bank.by_category))
+    return _cached_json_response(request, bank, "meta", lambda: _build_meta(bank))
 
 
 @app.get("/api/v1/questions/batch", response_model=QuestionBatchResponse)
-def get_questions_batch(
+async def get_questions_batch(
     userId: str = Query(...),
     limit: int = Query(30, ge=1, le=100),
     wrongOnly: bool = Query(False),
     avoidCorrect: bool = Query(False),
     randomMode: bool = Query(True),
+    category: Optional[List[str]] = Query(None),
+    weighted: bool = Query(False),
+    balanceCategories: bool = Query(False),
+    seed: Optional[int] = Query(None),
 ):
-    questions = load_questions()
-    if not questions:
+    bank = await get_bank_async()
+    if not len(bank):
         logger.warning("questions_batch requested but no questions available")
         return QuestionBatchResponse(questions=[])
 
-    db = get_db()
+    store = await get_store()
     now = datetime.now(timezone.utc)
+    rng = random if seed is None else random.Random(seed)
 
-    if db is None:
-        if randomMode or wrongOnly or avoidCorrect:
-            if limit >= len(questions):
-                selected = questions[:]
-                random.shuffle(selected)
-            else:
-                selected = random.sample(questions, limit)
-        else:
-            selected = questions[:limit]
+    if store is None and balanceCategories:
+        # 学習状態が無いので全問が new の状態から選ぶ（重みはすべて 1）
+        selected = _anonymous_schedule.select(
+            bank, limit, wrongOnly, avoidCorrect, randomMode, now, categories=category, balance=True, rng=rng
+        )
         logger.info(
-            "questions_batch without Firestore: userId=%s limit=%d selected=%d",
+            "questions_batch without store: userId=%s limit=%d balanced selected=%d",
             userId,
             limit,
             len(selected),
         )
         return QuestionBatchResponse(questions=selected)
 
-    state_docs = list(
-        db.collection("user_question_state").where("userId", "==", userId).stream()
-    )
-    state_map: Dict[str, Dict] = {}
-    for doc in state_docs:
-        data = doc.to_dict() or {}
-        qid = data.get("questionId")
-        if qid:
-            state_map[qid] = data
-
-    due: List[Question] = []
-    hard: List[Question] = []
-    new: List[Question] = []
-    others: List[Question] = []
-
-    for q in questions:
-        s = state_map.get(q.id)
-        if not s:
-            new.append(q)
-            continue
-        repetitions = int(s.get("repetitions", 0))
-        next_review = s.get("nextReviewAt")
-        if isinstance(next_review, datetime) and next_review <= now:
-            due.append(q)
-        elif repetitions == 0:
-            hard.append(q)
-        else:
-            others.append(q)
-
-    selected: List[Question] = []
-
-    while len(selected) < limit and (due or hard or new or others):
-        if wrongOnly:
-            pool = hard or due or new or others
-        elif due:
-            pool = due
-        elif avoidCorrect:
-            pool = hard or new or others or due
-        else:
-            pool = new or due or others or hard
-
-        if not pool:
-            break
+    if store is None and category:
+        lists = bank.category_lists(category)
+        count = min(limit, sum(len(positions) for positions in lists))
+        shuffle = randomMode or wrongOnly or avoidCorrect or weighted
+        selected = bank.materialize(_take_positions(lists, count, shuffle, rng))
+        logger.info(
+            "questions_batch without store: userId=%s limit=%d categories=%d selected=%d",
+            userId,
+            limit,
+            len(lists),
+            len(selected),
+        )
+        return QuestionBatchResponse(questions=selected)
 
-        if randomMode or wrongOnly or avoidCorrect:
-            q = random.choice(pool)
+    if store is None:
+        if randomMode or wrongOnly or avoidCorrect or weighted:
+            if limit >= len(bank):
+                positions = list(range(len(bank)))
+                rng.shuffle(positions)
+            else:
+                positions = rng.sample(range(len(bank)), limit)
         else:
-            q = pool[0]
-
-        selected.append(q)
-        if q in hard:
-            hard.remove(q)
-        elif q in due:
-            due.remove(q)
-        elif q in new:
-            new.remove(q)
-        elif q in others:
-            others.remove(q)
+            positions = range(min(limit, len(bank)))
+        selected = bank.materialize(positions)
+        logger.info(
+            "questions_batch without store: userId=%s limit=%d selected=%d",
+            userId,
+            limit,
+            len(selected),
+        )
+        return QuestionBatchResponse(questions=selected)
 
+    schedule = await _load_user_schedule(store, userId)
+    selected = schedule.select(
+        bank,
+        limit,
+        wrongOnly,
+        avoidCorrect,
+        randomMode,
+        now,
+        categories=category,
+        weighted=weighted,
+        balance=balanceCategories,
+        rng=rng,
+    )
+    counts = schedule.counts()
     logger.info(
-        "questions_batch with Firestore: userId=%s limit=%d selected=%d due=%d hard=%d new=%d others=%d",
+        "questions_batch with %s: userId=%s limit=%d selected=%d due=%d hard=%d new=%d others=%d",
+        store.name,
         userId,
         limit,
         len(selected),
-        len(due),
-        len(hard),
-        len(new),
-        len(others),
+        counts["due"],
+        counts["hard"],
+        counts["new"],
+        counts["others"],
     )
     return QuestionBatchResponse(questions=selected)
 
 
 @app.post("/api/v1/answers", response_model=AnswerResponse)
-def submit_answer(payload: AnswerRequest):
-    questions = load_questions()
-    q = next((x for x in questions if x.id == payload.questionId), None)
-    if q is None:
+async def submit_answer(payload: AnswerRequest):
+    bank = await get_bank_async()
+    if payload.questionId not in bank:
         logger.warning(
             "submit_answer: question not found userId=%s questionId=%s",
             payload.userId,
             payload.questionId,
         )
         raise HTTPException(status_code=404, detail="question not found")
-    correct = q.answer == payload.choice
+    correct = bank.is_correct(payload.questionId, payload.choice)
 
-    db = get_db()
-    repetitions = 0
-    interval = 1
-    ease = 2.5
-    if db is not None:
-        state_ref = db.collection("user_question_state").document(
-            f"{payload.userId}_{payload.questionId}"
-        )
-        state_doc = state_ref.get()
-        if state_doc.exists:
-            state = state_doc.to_dict() or {}
-            repetitions = int(state.get("repetitions", 0))
-            interval = int(state.get("interval", 1))
-            ease = float(state.get("ease", 2.5))
-    repetitions, interval, ease, next_review = _update_schedule(
-        repetitions, interval, ease, correct, payload.elapsedMs
+    store = await get_store()
+    repetitions, interval, ease = _schedule_fields(None)
+    if store is not None:
+        states = await store.get_user_states(payload.userId, [payload.questionId])
+        repetitions, interval, ease = _schedule_fields(states.get(payload.questionId))
+    now = datetime.now(timezone.utc)
+    repetitions, interval, ease, next_review = update_schedule(
+        repetitions, interval, ease, correct, payload.elapsedMs, now
     )
-    if db is not None:
-        state_ref = db.collection("user_question_state").document(
-            f"{payload.userId}_{payload.questionId}"
-        )
-        state_ref.set(
-            {
-                "userId": payload.userId,
-                "questionId": payload.questionId,
-                "repetitions": repetitions,
-                "interval": interval,
-                "ease": ease,
-                "nextReviewAt": next_review,
-                "updatedAt": datetime.now(timezone.utc),
-            },
-            merge=True,
-        )
-        answers_ref = db.collection("answers")
-        answers_ref.add(
-            {
-                "userId": payload.userId,
-                "questionId": payload.questionId,
-                "choice": payload.choice,
-                "correct": correct,
-                "elapsedMs": payload.elapsedMs,
-                "createdAt": datetime.now(timezone.utc),
-            }
-        )
-        stats_ref = db.collection("user_stats").document(payload.userId)
-        stats_doc = stats_ref.get()
-        total_answers = 0
-        correct_count = 0
-        total_elapsed = 0
-        if stats_doc.exists:
-            stats = stats_doc.to_dict() or {}
-            total_answers = int(stats.get("totalAnswers", 0))
-            correct_count = int(stats.get("correctCount", 0))
-            total_elapsed = int(stats.get("totalElapsedMs", 0))
-        total_answers += 1
-        if correct:
-            correct_count += 1
-        total_elapsed += max(0, int(payload.elapsedMs))
-        accuracy = correct_count / total_answers if total_answers > 0 else 0.0
-        stats_ref.set(
-            {
-                "userId": payload.userId,
-                "totalAnswers": total_answers,
-                "correctCount": correct_count,
-                "totalElapsedMs": total_elapsed,
-                "accuracy": accuracy,
-                "lastAnsweredAt": datetime.now(timezone.utc),
-            },
-            merge=True,
-        )
+    if store is not None:
+        state = {
+            "userId": payload.userId,
+            "questionId": payload.questionId,
+            "repetitions": repetitions,
+            "interval": interval,
+            "ease": ease,
+            "nextReviewAt": next_review,
+            "updatedAt": now,
+        }
+        answer = {
+            "userId": payload.userId,
+            "questionId": payload.questionId,
+            "choice": payload.choice,
+            "correct": correct,
+            "elapsedMs": payload.elapsedMs,
+            "createdAt": now,
+        }
+        try:
+            await store.record_answers(payload.userId, [answer], {payload.questionId: state}, now)
+        except Exception:
+            _user_states.invalidate(payload.userId)
+            raise
+        _user_states.update(payload.userId, payload.questionId, state)
     logger.info(
         "submit_answer: userId=%s questionId=%s correct=%s elapsedMs=%d",
         payload.userId,
@@ -524,21 +1812,71 @@ def submit_answer(payload: AnswerRequest):
     return AnswerResponse(correct=correct, nextReviewAt=next_review)
 
 
+async def _write_session_results(store, user_id: str, graded) -> None:
+    question_ids = list(dict.fromkeys(item.questionId for item, _ in graded))
+    stored = await store.get_user_states(user_id, question_ids)
+    initial = {qid: _schedule_fields(stored.get(qid)) for qid in question_ids}
+    # 同じ問題への複数回答は順に、異なる問題はまとめて計算する
+    states, _ = replay_schedules(
+        initial, [(item.questionId, correct, item.elapsedMs) for item, correct in graded]
+    )
+    now = datetime.now(timezone.utc)
+    answers = [
+        {
+            "userId": user_id,
+            "questionId": item.questionId,
+            "choice": item.choice,
+            "correct": correct,
+            "elapsedMs": item.elapsedMs,
+            "createdAt": now,
+        }
+        for item, correct in graded
+    ]
+    new_states: Dict[str, Dict] = {}
+    for qid, (repetitions, interval, ease) in states.items():
+        new_states[qid] = {
+            "userId": user_id,
+            "questionId": qid,
+            "repetitions": repetitions,
+            "interval": interval,
+            "ease": ease,
+            "nextReviewAt": next_review_at(now, interval),
+            "updatedAt": now,
+        }
+    try:
+        await store.record_answers(user_id, answers, new_states, now)
+    except Exception:
+        # 一部のチャンクのみ書き込まれた可能性があるためキャッシュを破棄する
+        _user_states.invalidate(user_id)
+        raise
+    for qid, state in new_states.items():
+        _user_states.update(user_id, qid, state)
+
+
+def _grade_results(bank: QuestionBank, user_id: str, results: List[SessionResultItem]):
+    graded = []
+    for item in results:
+        if item.questionId not in bank:
+            logger.warning(
+                "session_results: question not found userId=%s questionId=%s",
+                user_id,
+                item.questionId,
+            )
+            raise HTTPException(status_code=404, detail="question not found")
+        graded.append((item, bank.is_correct(item.questionId, item.choice)))
+    return graded
+
+
 @app.post("/api/v1/session/results", response_model=SessionResultsResponse)
-def submit_session_results(payload: SessionResultsRequest):
-    total = 0
-    correct = 0
-    for item in payload.results:
-        answer_payload = AnswerRequest(
-            userId=payload.userId,
-            questionId=item.questionId,
-            choice=item.choice,
-            elapsedMs=item.elapsedMs,
-        )
-        resp = submit_answer(answer_payload)
-        total += 1
-        if resp.correct:
-            correct += 1
+async def submit_session_results(payload: SessionResultsRequest):
+    bank = await get_bank_async()
+    graded = _grade_results(bank, payload.userId, payload.results)
+
+    total = len(graded)
+    correct = sum(1 for _, ok in graded if ok)
+    store = await get_store()
+    if store is not None and graded:
+        await _write_session_results(store, payload.userId, graded)
     logger.info(
         "session_results: userId=%s total=%d correct=%d",
         payload.userId,
@@ -548,36 +1886,169 @@ def submit_session_results(payload: SessionResultsRequest):
     return SessionResultsResponse(totalAnswers=total, correctCount=correct)
 
 
-@app.get("/api/v1/stats", response_model=StatsResponse)
-def get_stats(userId: str = Query(...)):
-    db = get_db()
-    if db is None:
-        logger.info("stats requested without Firestore: userId=%s", userId)
-        return StatsResponse(totalAnswers=0, correctCount=0, accuracy=0.0)
-    stats_ref = db.collection("user_stats").document(userId)
-    stats_doc = stats_ref.get()
-    if stats_doc.exists:
-        data = stats_doc.to_dict() or {}
-        total = int(data.get("totalAnswers", 0))
-        correct = int(data.get("correctCount", 0))
-        accuracy = float(data.get("accuracy", 0.0))
-        logger.info(
-            "stats requested from user_stats: userId=%s total=%d correct=%d accuracy=%.4f",
-            userId,
-            total,
-            correct,
-            accuracy,
+async def _fill_session(session: QuizSession, bank: QuestionBank, minimum: int) -> None:
+    if session.queue_layout is not bank.layout:
+        # 問題の位置が変わったバンクではキューを作り直す
+        session.queue = []
+        session.queue_layout = bank.layout
+    target = max(minimum, session.page_size * max(1, SESSION_PREFETCH_PAGES))
+    if min(target, session.remaining) <= len(session.queue):
+        return
+    store = await get_store()
+    schedule = _anonymous_schedule if store is None else await _load_user_schedule(store, session.user_id)
+    # 選んだ位置に同じ ID が含まれると 1 回では足りないため、埋まるか何も増えなくなるまで繰り返す
+    while True:
+        wanted = min(target, session.remaining) - len(session.queue)
+        if wanted <= 0:
+            return
+        # 出題済み・キュー内の ID は重複位置も含めて除く（件数はセッションの大きさまで）
+        exclude = set()
+        for qid in session.served_ids.union(bank.ids[pos] for pos in session.queue):
+            exclude.update(bank.positions(qid))
+        positions = schedule.select_positions(
+            bank,
+            wanted,
+            session.wrong_only,
+            session.avoid_correct,
+            session.random_mode,
+            datetime.now(timezone.utc),
+            exclude,
+            session.categories,
+            session.weighted,
+            session.balance,
+            session.rng,
         )
-        return StatsResponse(totalAnswers=total, correctCount=correct, accuracy=accuracy)
-    docs = list(db.collection("answers").where("userId", "==", userId).stream())
-    total = len(docs)
-    if total == 0:
-        logger.info("stats requested: userId=%s total=0", userId)
+        added = set()
+        for pos in positions:
+            qid = bank.ids[pos]
+            if qid not in added:
+                added.add(qid)
+                session.queue.append(pos)
+        if not added:
+            # 残りの問題が無い場合はセッションを短くする
+            session.total = len(session.served) + len(session.queue)
+            return
+
+
+async def _prefetch_session(session: QuizSession) -> None:
+    try:
+        await _fill_session(session, await get_bank_async(), 0)
+    except Exception as e:
+        # 次のページ取得時に同期的に計算し直す
+        logger.warning("session prefetch failed: sessionId=%s %s", session.id, e)
+
+
+async def _session_page(session: QuizSession, limit: int) -> List[Question]:
+    async with session.lock:
+        if session.prefetch is not None:
+            task, session.prefetch = session.prefetch, None
+            await task
+        bank = await get_bank_async()
+        take = min(limit, session.remaining)
+        if session.queue_layout is not bank.layout or len(session.queue) < take:
+            await _fill_session(session, bank, take)
+            take = min(take, len(session.queue))
+        positions = session.queue[:take]
+        del session.queue[:take]
+        questions = bank.materialize(positions)
+        for question in questions:
+            session.served.append(question.id)
+            session.served_ids.add(question.id)
+        if len(session.queue) < min(session.page_size * max(1, SESSION_PREFETCH_PAGES), session.remaining):
+            # 回答している間に次のページ分を計算しておく
+            session.prefetch = asyncio.create_task(_prefetch_session(session))
+        return questions
+
+
+def _get_session(session_id: str) -> QuizSession:
+    session = _sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="session not found")
+    return session
+
+
+@app.post("/api/v1/sessions", response_model=SessionPageResponse)
+async def create_session(payload: SessionCreateRequest):
+    bank = await get_bank_async()
+    if payload.category:
+        available = sum(len(positions) for positions in bank.category_lists(payload.category))
+    else:
+        available = len(bank.index)
+    session = QuizSession(
+        payload.userId,
+        min(payload.size, available),
+        payload.pageSize,
+        payload.wrongOnly,
+        payload.avoidCorrect,
+        payload.randomMode,
+        payload.category or None,
+        payload.weighted,
+        payload.balanceCategories,
+        payload.seed,
+    )
+    questions = await _session_page(session, session.page_size)
+    _sessions.put(session)
+    logger.info(
+        "create_session: userId=%s sessionId=%s total=%d served=%d",
+        session.user_id,
+        session.id,
+        session.total,
+        len(questions),
+    )
+    return SessionPageResponse(
+        sessionId=session.id, total=session.total, remaining=session.remaining, questions=questions
+    )
+
+
+@app.get("/api/v1/sessions/{sessionId}/questions", response_model=SessionPageResponse)
+async def get_session_questions(sessionId: str, limit: Optional[int] = Query(None, ge=1, le=100)):
+    session = _get_session(sessionId)
+    questions = await _session_page(session, limit or session.page_size)
+    return SessionPageResponse(
+        sessionId=session.id, total=session.total, remaining=session.remaining, questions=questions
+    )
+
+
+@app.post("/api/v1/sessions/{sessionId}/results", response_model=SessionResultsResponse)
+async def submit_session(sessionId: str, payload: SessionSubmitRequest):
+    session = _get_session(sessionId)
+    bank = await get_bank_async()
+    graded = _grade_results(bank, session.user_id, payload.results)
+    for item, _ in graded:
+        if item.questionId not in session.served_ids:
+            raise HTTPException(status_code=400, detail="question not served in this session")
+    if _sessions.pop(sessionId) is None:
+        raise HTTPException(status_code=404, detail="session not found")
+    if session.prefetch is not None:
+        session.prefetch.cancel()
+
+    total = len(graded)
+    correct = sum(1 for _, ok in graded if ok)
+    store = await get_store()
+    if store is not None and graded:
+        await _write_session_results(store, session.user_id, graded)
+    logger.info(
+        "submit_session: userId=%s sessionId=%s served=%d total=%d correct=%d",
+        session.user_id,
+        session.id,
+        len(session.served),
+        total,
+        correct,
+    )
+    return SessionResultsResponse(totalAnswers=total, correctCount=correct)
+
+
+@app.get("/api/v1/stats", response_model=StatsResponse)
+async def get_stats(userId: str = Query(...)):
+    store = await get_store()
+    if store is None:
+        logger.info("stats requested without store: userId=%s", userId)
         return StatsResponse(totalAnswers=0, correctCount=0, accuracy=0.0)
-    correct = sum(1 for d in docs if (d.to_dict() or {}).get("correct"))
-    accuracy = correct / total
+    total, correct = await store.get_stats(userId)
+    accuracy = correct / total if total > 0 else 0.0
     logger.info(
-        "stats requested from answers: userId=%s total=%d correct=%d accuracy=%.4f",
+        "stats requested from %s: userId=%s total=%d correct=%d accuracy=%.4f",
+        store.name,
         userId,
         total,
         correct,
@@ -591,6 +2062,11 @@ def health():
     return {"status": "ok"}
 
 
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 app.mount("/", StaticFiles(directory=BASE_DIR, html=True), name="static")
 
 
@@ -1,42 +1,49 @@
 import json
 from pathlib import Path
 
+from ingest import SCHEMA_FILE, ingest, read_items
+
 data_dir = Path(r"i:\My Drive\KUIZ\kihon\data")
 questions_path = data_dir / "questions.json"
 q2_path = data_dir / "q2.json"
 output_path = data_dir / "kihon.json"
 
-with open(questions_path, "r", encoding="utf-8") as f:
-    questions = json.load(f)
-
-with open(q2_path, "r", encoding="utf-8") as f:
-    q2 = json.load(f)
-
-merged = questions.copy()
-next_id = max(q["id"] for q in questions) + 1 if questions else 1
-
-for item in q2:
-    choices = item.get("choices", [])
-    answer_text = item.get("answer", "")
-    
-    # Find index (1-based)
-    try:
-        answer_idx = choices.index(answer_text) + 1
-    except ValueError:
-        print(f"Warning: Answer '{answer_text}' not found in choices for question: {item.get('question')[:20]}...")
-        answer_idx = 1 # Default
-    
-    merged.append({
-        "id": next_id,
-        "category": item.get("category", "基本情報"),
-        "question": item.get("question"),
-        "options": choices,
-        "answer": answer_idx,
-        "explanation": item.get("explanation", None)
-    })
-    next_id += 1
 
+def _write_item(f, item, first):
+    # json.dump(list, indent=2) と同じ整形で 1 件ずつ書き出す
+    body = json.dumps(item, ensure_ascii=False, indent=2).replace("\n", "\n  ")
+    f.write(("" if first else ",") + "\n  " + body)
+
+
+# 既存の問題は元の形式のまま引き継ぎ、新しい ID は最大値の次から振る
+max_id = 0
+for _, _, item in read_items([questions_path]):
+    max_id = max(max_id, int(item["id"]))
+next_id = max_id + 1
+
+count = 0
 with open(output_path, "w", encoding="utf-8") as f:
-    json.dump(merged, f, ensure_ascii=False, indent=2)
+    f.write("[")
+    for _, _, item in read_items([questions_path]):
+        _write_item(f, item, count == 0)
+        count += 1
+
+    # q2 は choices + 正解テキスト形式のため共通パイプラインで正規化し、1-based の answer に戻す
+    for record in ingest([q2_path], schema_file=SCHEMA_FILE):
+        _write_item(
+            f,
+            {
+                "id": next_id,
+                "category": record["category"],
+                "question": record["question"],
+                "options": record["options"],
+                "answer": record["answer"] + 1,
+                "explanation": record["explanation"],
+            },
+            count == 0,
+        )
+        next_id += 1
+        count += 1
+    f.write("\n]" if count else "]")
 
-print(f"Successfully merged {len(merged)} questions into kihon.json")
+print(f"Successfully merged {count} questions into kihon.json")
@@ -0,0 +1,238 @@
+# リクエスト単位のストア操作数・時間の計測
+#
+# リクエストごとに RequestMetrics を contextvars で持ち回り、Firestore を呼び出す箇所
+# （main._db_io など）で record_db_op() を、SQLite ストアでは record_ops() を呼ぶ。
+# 集計結果はレスポンスの Server-Timing ヘッダと、/metrics で公開する
+# Prometheus テキスト形式のルート別ヒストグラムに反映する。
+# answer_log のバックグラウンド書き込みはリクエストの外で行うため、件数だけを別に数える。
+# 値はプロセス単位で集計される（uvicorn --workers の場合はワーカーごと）。
+
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from starlette.datastructures import MutableHeaders
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+OPS_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+OP_KINDS = ("reads", "writes", "queries", "aggregations", "commits")
+
+
+class RequestMetrics:
+    __slots__ = ("ops", "db_seconds")
+
+    def __init__(self):
+        self.ops: Counter = Counter()
+        # 並行に発行した呼び出しはそれぞれの所要時間を合算する
+        self.db_seconds = 0.0
+
+
+_current: ContextVar[Optional[RequestMetrics]] = ContextVar("quiz_request_metrics", default=None)
+
+
+def classify_db_op(fn, result) -> Dict[str, int]:
+    name = getattr(fn, "__name__", "")
+    owner = type(getattr(fn, "__self__", None)).__name__
+    if "Aggregation" in owner:
+        return {"aggregations": 1}
+    if name in ("get_all", "stream"):
+        docs = len(result) if isinstance(result, list) else 1
+        if name == "get_all":
+            return {"reads": docs}
+        # 0 件のクエリも 1 読み取りとして課金される
+        return {"reads": max(1, docs), "queries": 1}
+    if name == "get":
+        return {"reads": 1}
+    if name == "commit":
+        # commit() は書き込みごとに WriteResult を 1 件返す（バッチ側の一覧は commit 時に空になる）
+        return {"writes": len(result) if isinstance(result, list) else 1, "commits": 1}
+    if name in ("set", "add", "create", "update", "delete"):
+        return {"writes": 1}
+    return {"other": 1}
+
+
+def record_ops(ops: Dict[str, int], seconds: float) -> None:
+    metrics = _current.get()
+    if metrics is None:
+        return
+    metrics.ops.update(ops)
+    metrics.db_seconds += seconds
+
+
+def record_db_op(fn, result, seconds: float) -> None:
+    if _current.get() is not None:
+        record_ops(classify_db_op(fn, result), seconds)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...], buckets):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: Tuple[str, ...], value: float) -> None:
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # [バケットごとの件数..., 合計, 件数]
+                series = self._series[labels] = [0] * len(self.buckets) + [0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((labels, list(series)) for labels, series in self._series.items())
+        for labels, series in items:
+            for bound, count in zip(self.buckets, series):
+                le = _format_labels(self.labelnames, labels, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {count}")
+            inf = _format_labels(self.labelnames, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{inf} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(series[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {series[-1]}")
+        return lines
+
+
+class CounterMetric:
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...]):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def inc(self, labels: Tuple[str, ...], amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] += amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+REQUESTS = CounterMetric(
+    "quiz_http_requests_total", "HTTP requests by route and status.", ("route", "method", "status")
+)
+REQUEST_DURATION = Histogram(
+    "quiz_http_request_duration_seconds",
+    "Time to produce the response headers.",
+    ("route", "method"),
+    DURATION_BUCKETS,
+)
+DB_DURATION = Histogram(
+    "quiz_firestore_duration_seconds",
+    "Cumulative Firestore call time per request.",
+    ("route", "method"),
+    DURATION_BUCKETS,
+)
+DB_OPS = Histogram(
+    "quiz_firestore_operations_per_request",
+    "Firestore operations per request by kind.",
+    ("route", "method", "kind"),
+    OPS_BUCKETS,
+)
+DB_OPS_TOTAL = CounterMetric(
+    "quiz_firestore_operations_total", "Firestore operations by route and kind.", ("route", "method", "kind")
+)
+ANSWER_LOG_RECORDS = CounterMetric(
+    "quiz_answer_log_records_total", "Answer records handled by the write-behind log.", ("result",)
+)
+
+_REGISTRY = (REQUESTS, REQUEST_DURATION, DB_DURATION, DB_OPS, DB_OPS_TOTAL, ANSWER_LOG_RECORDS)
+
+
+def render_metrics() -> str:
+    lines: List[str] = []
+    for metric in _REGISTRY:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+def server_timing(metrics: RequestMetrics, total_seconds: float) -> str:
+    entries = [f"total;dur={total_seconds * 1000:.2f}", f"db;dur={metrics.db_seconds * 1000:.2f}"]
+    for kind in OP_KINDS:
+        if metrics.ops.get(kind):
+            entries.append(f'db-{kind};desc="{metrics.ops[kind]}"')
+    return ", ".join(entries)
+
+
+def _route_label(scope) -> str:
+    route = scope.get("route")
+    if route is not None and getattr(route, "path", ""):
+        return route.path
+    # マウントしたアプリ（StaticFiles など）はパスごとに分けず 1 系列にまとめる
+    endpoint = scope.get("endpoint")
+    if endpoint is not None:
+        return type(endpoint).__name__
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    def __init__(self, app, exclude: Tuple[str, ...] = ("/metrics",)):
+        self.app = app
+        self.exclude = exclude
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.exclude:
+            await self.app(scope, receive, send)
+            return
+
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        start = time.perf_counter()
+        status = 500
+        elapsed = None
+
+        async def _send(message):
+            nonlocal status, elapsed
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                elapsed = time.perf_counter() - start
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", server_timing(metrics, elapsed))
+                headers.append("Timing-Allow-Origin", "*")
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            _current.reset(token)
+            if elapsed is None:
+                elapsed = time.perf_counter() - start
+            labels = (_route_label(scope), scope["method"])
+            REQUESTS.inc(labels + (str(status),))
+            REQUEST_DURATION.observe(labels, elapsed)
+            DB_DURATION.observe(labels, metrics.db_seconds)
+            for kind in OP_KINDS:
+                count = metrics.ops.get(kind, 0)
+                DB_OPS.observe(labels + (kind,), count)
+                if count:
+                    DB_OPS_TOTAL.inc(labels + (kind,), count)
@@ -0,0 +1,162 @@
+# answers コレクションから user_stats を再構築するバッチ
+#
+#   python rebuild_stats.py [--page-size 500] [--only-missing] [--checkpoint PATH]
+#
+# answers を userId 順にページングして集計し、ユーザー単位で user_stats を上書きする。
+# ページごとにチェックポイントを保存するため、途中で失敗しても同じコマンドで再開できる。
+# 上書き中に同じユーザーの回答が届くと加算が失われるため、アクセスの少ない時間に実行すること。
+
+import argparse
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from ingest import STATE_DIR
+from main import FIRESTORE_BATCH_LIMIT, STATS_SHARDS, _private_path, get_db
+
+
+logger = logging.getLogger("quiz.rebuild_stats")
+
+# ユーザー ID と途中の集計を含むため、静的ファイルとして公開されるリポジトリの外に置く
+DEFAULT_CHECKPOINT = STATE_DIR / "rebuild_stats.checkpoint.json"
+
+
+def _new_totals(user_id: str) -> Dict:
+    return {
+        "userId": user_id,
+        "totalAnswers": 0,
+        "correctCount": 0,
+        "totalElapsedMs": 0,
+        "lastAnsweredAt": None,
+    }
+
+
+def _accumulate(totals: Dict, data: Dict) -> None:
+    totals["totalAnswers"] += 1
+    if data.get("correct"):
+        totals["correctCount"] += 1
+    totals["totalElapsedMs"] += max(0, int(data.get("elapsedMs") or 0))
+    created_at = data.get("createdAt")
+    if isinstance(created_at, datetime):
+        last = totals["lastAnsweredAt"]
+        if last is None or created_at > last:
+            totals["lastAnsweredAt"] = created_at
+
+
+def _load_checkpoint(path: Path) -> Optional[Dict]:
+    if not path.exists():
+        return None
+    data = json.loads(path.read_text(encoding="utf-8"))
+    current = data.get("current")
+    if current and current.get("lastAnsweredAt"):
+        current["lastAnsweredAt"] = datetime.fromisoformat(current["lastAnsweredAt"])
+    return data
+
+
+def _save_checkpoint(path: Path, last_doc_id: str, current: Optional[Dict], users_written: int) -> None:
+    if current is not None:
+        current = dict(current)
+        if current["lastAnsweredAt"] is not None:
+            current["lastAnsweredAt"] = current["lastAnsweredAt"].isoformat()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(
+        json.dumps(
+            {"lastDocId": last_doc_id, "current": current, "usersWritten": users_written},
+            ensure_ascii=False,
+        ),
+        encoding="utf-8",
+    )
+    tmp.replace(path)
+
+
+def _write_users(db, finished: List[Dict], only_missing: bool) -> int:
+    if not finished:
+        return 0
+    coll = db.collection("user_stats")
+    refs = [coll.document(totals["userId"]) for totals in finished]
+    if only_missing:
+        existing = {snap.id for snap in db.get_all(refs) if snap.exists}
+        pairs = [(ref, totals) for ref, totals in zip(refs, finished) if ref.id not in existing]
+    else:
+        pairs = list(zip(refs, finished))
+
+    ops = []
+    for ref, totals in pairs:
+        # シャード化されたカウンタは再構築した値に含まれるため削除する
+        if STATS_SHARDS > 1:
+            for shard in ref.collection("shards").stream():
+                ops.append(("delete", shard.reference, None))
+        data = {k: v for k, v in totals.items() if v is not None}
+        ops.append(("set", ref, data))
+
+    for start in range(0, len(ops), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for kind, ref, data in ops[start:start + FIRESTORE_BATCH_LIMIT]:
+            if kind == "delete":
+                batch.delete(ref)
+            else:
+                batch.set(ref, data)
+        batch.commit()
+    return len(pairs)
+
+
+def rebuild_user_stats(db, page_size: int, checkpoint_path: Path, only_missing: bool = False) -> int:
+    answers = db.collection("answers")
+    query = answers.order_by("userId").limit(page_size)
+
+    checkpoint_path = _private_path(checkpoint_path)
+    checkpoint = _load_checkpoint(checkpoint_path)
+    cursor = None
+    current: Optional[Dict] = None
+    users_written = 0
+    if checkpoint:
+        cursor = answers.document(checkpoint["lastDocId"]).get()
+        if not cursor.exists:
+            raise RuntimeError(f"checkpoint document {checkpoint['lastDocId']} no longer exists")
+        current = checkpoint.get("current")
+        users_written = int(checkpoint.get("usersWritten", 0))
+        logger.info("rebuild_stats: resuming after %s (users_written=%d)", cursor.id, users_written)
+
+    while True:
+        page = query.start_after(cursor) if cursor is not None else query
+        docs = list(page.stream())
+        if not docs:
+            break
+        finished: List[Dict] = []
+        for doc in docs:
+            data = doc.to_dict() or {}
+            user_id = data.get("userId")
+            if current is None or current["userId"] != user_id:
+                if current is not None:
+                    finished.append(current)
+                current = _new_totals(user_id)
+            _accumulate(current, data)
+        # 書き込み完了後にチェックポイントを進める（再開時に集計済みユーザーを取りこぼさない）
+        users_written += _write_users(db, finished, only_missing)
+        cursor = docs[-1]
+        _save_checkpoint(checkpoint_path, cursor.id, current, users_written)
+        logger.info("rebuild_stats: processed page ending at %s users_written=%d", cursor.id, users_written)
+
+    if current is not None:
+        users_written += _write_users(db, [current], only_missing)
+    if checkpoint_path.exists():
+        checkpoint_path.unlink()
+    return users_written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="answers から user_stats を再構築する")
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--checkpoint", type=Path, default=DEFAULT_CHECKPOINT)
+    parser.add_argument("--only-missing", action="store_true", help="user_stats が無いユーザーのみ書き込む")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    db = get_db()
+    if db is None:
+        raise SystemExit("Firestore is not available")
+    written = rebuild_user_stats(db, args.page_size, args.checkpoint, args.only_missing)
+    print(f"Rebuilt user_stats for {written} users")
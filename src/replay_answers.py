@@ -0,0 +1,182 @@
+# answers コレクションを再生して user_question_state を再構築するバッチ
+#
+#   python replay_answers.py [--page-size 5000] [--workers 4] [--checkpoint PATH] [--dry-run]
+#
+# answers を userId, createdAt 順にページングし、ユーザーごとの回答列をプロセスプールで
+# 並列に SM-2 で再生して、結果の状態を 500 件単位のバッチで上書きする。次回復習日時は
+# 再生時の現在時刻ではなく、その問題に最後に回答した createdAt を基準に計算する。
+# スケジューラのパラメータを変更した後などに実行する。
+# ページごとにチェックポイントを保存するため、途中で失敗しても同じコマンドで再開できる。
+#
+# 注意:
+# - userId 昇順・createdAt 昇順の複合インデックスが必要
+# - セッション送信の回答は createdAt が同じため、同一セッション内で同じ問題に複数回答した
+#   場合の順序はドキュメント ID 順になる
+# - 起動中のサーバーはユーザー状態をキャッシュしているため、反映は最大
+#   QUIZ_USER_STATE_TTL_SECONDS 遅れる
+
+import argparse
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from ingest import STATE_DIR
+from main import FIRESTORE_BATCH_LIMIT, _private_path, _state_doc_id, get_db
+from sm2 import next_review_at, replay_schedules
+
+
+logger = logging.getLogger("quiz.replay_answers")
+
+# ユーザー ID と途中の集計を含むため、静的ファイルとして公開されるリポジトリの外に置く
+DEFAULT_CHECKPOINT = STATE_DIR / "replay_answers.checkpoint.json"
+
+# (questionId, correct, elapsedMs, createdAt の ISO 文字列)
+Event = Tuple[str, bool, int, Optional[str]]
+
+
+def _event(data: Dict) -> Event:
+    created_at = data.get("createdAt")
+    return (
+        str(data.get("questionId")),
+        bool(data.get("correct")),
+        int(data.get("elapsedMs") or 0),
+        created_at.isoformat() if isinstance(created_at, datetime) else None,
+    )
+
+
+def replay_user(user_id: str, events: List[Event]) -> List[Dict]:
+    # プロセスプールで実行するため、引数・戻り値は pickle できる値だけにする
+    states, last = replay_schedules({}, [(qid, correct, elapsed) for qid, correct, elapsed, _ in events])
+    now = datetime.now(timezone.utc)
+    result = []
+    for qid, (repetitions, interval, ease) in states.items():
+        created_at = events[last[qid]][3]
+        answered_at = datetime.fromisoformat(created_at) if created_at else now
+        result.append(
+            {
+                "userId": user_id,
+                "questionId": qid,
+                "repetitions": repetitions,
+                "interval": interval,
+                "ease": ease,
+                "nextReviewAt": next_review_at(answered_at, interval),
+                "updatedAt": answered_at,
+            }
+        )
+    return result
+
+
+def _load_checkpoint(path: Path) -> Optional[Dict]:
+    if not path.exists():
+        return None
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+def _save_checkpoint(
+    path: Path, last_doc_id: str, current: Optional[Tuple[str, List[Event]]], users_written: int
+) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(
+        json.dumps(
+            {
+                "lastDocId": last_doc_id,
+                "current": {"userId": current[0], "events": current[1]} if current else None,
+                "usersWritten": users_written,
+            },
+            ensure_ascii=False,
+        ),
+        encoding="utf-8",
+    )
+    tmp.replace(path)
+
+
+def _write_states(db, states: List[Dict]) -> None:
+    coll = db.collection("user_question_state")
+    for start in range(0, len(states), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for state in states[start:start + FIRESTORE_BATCH_LIMIT]:
+            batch.set(coll.document(_state_doc_id(state["userId"], state["questionId"])), state)
+        batch.commit()
+
+
+def _replay_finished(db, pool, finished: List[Tuple[str, List[Event]]], dry_run: bool) -> int:
+    if not finished:
+        return 0
+    futures = [pool.submit(replay_user, user_id, events) for user_id, events in finished]
+    states: List[Dict] = []
+    for future in futures:
+        states += future.result()
+    if not dry_run:
+        _write_states(db, states)
+    logger.info("replay_answers: replayed users=%d states=%d", len(finished), len(states))
+    return len(finished)
+
+
+def replay_answers(
+    db, page_size: int, checkpoint_path: Path, workers: Optional[int] = None, dry_run: bool = False
+) -> int:
+    answers = db.collection("answers")
+    query = answers.order_by("userId").order_by("createdAt").limit(page_size)
+
+    checkpoint_path = _private_path(checkpoint_path)
+    checkpoint = _load_checkpoint(checkpoint_path)
+    cursor = None
+    current: Optional[Tuple[str, List[Event]]] = None
+    users_written = 0
+    if checkpoint:
+        cursor = answers.document(checkpoint["lastDocId"]).get()
+        if not cursor.exists:
+            raise RuntimeError(f"checkpoint document {checkpoint['lastDocId']} no longer exists")
+        if checkpoint.get("current"):
+            saved = checkpoint["current"]
+            current = (saved["userId"], [tuple(event) for event in saved["events"]])
+        users_written = int(checkpoint.get("usersWritten", 0))
+        logger.info("replay_answers: resuming after %s (users_written=%d)", cursor.id, users_written)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while True:
+            page = query.start_after(cursor) if cursor is not None else query
+            docs = list(page.stream())
+            if not docs:
+                break
+            finished: List[Tuple[str, List[Event]]] = []
+            for doc in docs:
+                data = doc.to_dict() or {}
+                user_id = data.get("userId")
+                if current is None or current[0] != user_id:
+                    if current is not None:
+                        finished.append(current)
+                    current = (user_id, [])
+                current[1].append(_event(data))
+            # ページの最後のユーザーは次のページに回答が続く可能性があるため持ち越す
+            users_written += _replay_finished(db, pool, finished, dry_run)
+            cursor = docs[-1]
+            if not dry_run:
+                _save_checkpoint(checkpoint_path, cursor.id, current, users_written)
+            logger.info("replay_answers: processed page ending at %s users_written=%d", cursor.id, users_written)
+
+        if current is not None:
+            users_written += _replay_finished(db, pool, [current], dry_run)
+    if checkpoint_path.exists() and not dry_run:
+        checkpoint_path.unlink()
+    return users_written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="answers を再生して user_question_state を再構築する")
+    parser.add_argument("--page-size", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=None, help="再生に使うプロセス数（既定は CPU 数）")
+    parser.add_argument("--checkpoint", type=Path, default=DEFAULT_CHECKPOINT)
+    parser.add_argument("--dry-run", action="store_true", help="再生するだけで書き込まない")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    db = get_db()
+    if db is None:
+        raise SystemExit("Firestore is not available")
+    replayed = replay_answers(db, args.page_size, args.checkpoint, args.workers, args.dry_run)
+    print(f"Replayed answers for {replayed} users")
@@ -0,0 +1,132 @@
+# 重み付きの非復元抽出とカテゴリ間の均等割り当て
+#
+# FenwickSampler は重みの累積和を Fenwick 木で持ち、1 件引くごとにその重みを 0 にする。
+# 構築は O(N)、K 件の抽出は O(K log N)。抽出後は重みを元に戻すため、同じ木を
+# 次の抽出にも使える（main.UserSchedule はバケットが変わるか一定時間が経つまでキャッシュし、
+# 状態の更新は update() で反映する）。
+# 乱数は random.Random 互換のオブジェクトを渡す（seed 指定で結果を再現できる）。
+
+import bisect
+import itertools
+from typing import List, Sequence, Tuple
+
+
+class FenwickSampler:
+    def __init__(self, weights: Sequence[float]):
+        n = len(weights)
+        self.weights = [float(w) for w in weights]
+        if any(w < 0 for w in self.weights):
+            raise ValueError("weights must be non-negative")
+        tree = [0.0] + self.weights
+        # 親ノードへ加算していく O(N) の構築
+        for i in range(1, n + 1):
+            parent = i + (i & -i)
+            if parent <= n:
+                tree[parent] += tree[i]
+        self._tree = tree
+        self._top = 1 << (n.bit_length() - 1) if n else 0
+        self.total = sum(self.weights)
+        self._drawn: List[tuple] = []
+
+    def __len__(self) -> int:
+        return len(self.weights)
+
+    def _add(self, index: int, delta: float) -> None:
+        i = index + 1
+        n = len(self.weights)
+        while i <= n:
+            self._tree[i] += delta
+            i += i & -i
+
+    def update(self, index: int, weight: float) -> None:
+        if weight < 0:
+            raise ValueError("weights must be non-negative")
+        self._add(index, weight - self.weights[index])
+        self.total += weight - self.weights[index]
+        self.weights[index] = weight
+
+    def _find(self, u: float) -> int:
+        # 累積和が u を超える最初の添字
+        pos = 0
+        step = self._top
+        tree = self._tree
+        n = len(self.weights)
+        while step:
+            nxt = pos + step
+            if nxt <= n and tree[nxt] <= u:
+                pos = nxt
+                u -= tree[nxt]
+            step >>= 1
+        return pos
+
+    def draw(self, rng) -> int:
+        # 1 件引いて重みを 0 にする（restore() で戻す）
+        index = self._find(rng.random() * self.total)
+        if index >= len(self.weights) or self.weights[index] <= 0:
+            # 浮動小数点の誤差で範囲外・抽出済みに当たった場合は残りの先頭を使う
+            index = next(i for i, w in enumerate(self.weights) if w > 0)
+        weight = self.weights[index]
+        self._add(index, -weight)
+        self.total -= weight
+        self.weights[index] = 0.0
+        self._drawn.append((index, weight))
+        return index
+
+    def restore(self) -> None:
+        for index, weight in reversed(self._drawn):
+            self._add(index, weight)
+            self.weights[index] = weight
+            self.total += weight
+        self._drawn = []
+
+    def remaining(self) -> int:
+        return len(self.weights) - len(self._drawn)
+
+    def sample(self, k: int, rng) -> List[int]:
+        if k > self.remaining():
+            raise ValueError("sample larger than population")
+        try:
+            return [self.draw(rng) for _ in range(k)]
+        finally:
+            self.restore()
+
+
+def sample_union(samplers: Sequence[FenwickSampler], k: int, rng) -> List[Tuple[int, int]]:
+    # 複数の木をまとめて 1 つの母集団として引く。戻り値は (木の添字, 要素の添字)
+    if k > sum(s.remaining() for s in samplers):
+        raise ValueError("sample larger than population")
+    selected = []
+    try:
+        for _ in range(k):
+            totals = list(itertools.accumulate(s.total for s in samplers))
+            j = bisect.bisect_right(totals, rng.random() * totals[-1])
+            j = min(j, len(samplers) - 1)
+            while not samplers[j].remaining() or samplers[j].total <= 0:
+                j = (j + 1) % len(samplers)
+            selected.append((j, samplers[j].draw(rng)))
+    finally:
+        for sampler in samplers:
+            sampler.restore()
+    return selected
+
+
+def balanced_counts(sizes: Sequence[int], k: int, rng) -> List[int]:
+    # k 件をできるだけ均等に割り当てる（小さいグループは全件、残りを他のグループで分ける）。
+    # 割り切れない余りは rng で選んだグループに 1 件ずつ足す（k がグループ数より少ない場合も同様）
+    counts = [0] * len(sizes)
+    order = sorted(range(len(sizes)), key=lambda i: sizes[i])
+    remaining = min(k, sum(sizes))
+    for done, i in enumerate(order):
+        share = remaining // (len(order) - done)
+        if sizes[i] <= share:
+            counts[i] = sizes[i]
+            remaining -= sizes[i]
+            continue
+        # 以降のグループはすべて share + 1 件以上ある
+        rest = order[done:]
+        for j in rest:
+            counts[j] = share
+        for j in rng.sample(rest, remaining - share * len(rest)):
+            counts[j] += 1
+        break
+    return counts
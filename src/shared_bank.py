@@ -0,0 +1,156 @@
+# 複数ワーカー（uvicorn --workers / gunicorn）で問題バンクを共有する
+#
+# 共有ディレクトリ（既定は /dev/shm 配下）に次のファイルを置く:
+#   control          世代番号・確認時刻・バージョンを持つ固定長ファイル（各ワーカーが mmap）
+#   bank.<世代番号>  bank_format 形式のバンク。各ワーカーが読み取り専用で mmap する
+#   lock             読み込み・公開を 1 ワーカーに限る flock
+#   leader           変更リスナーを動かすワーカーが保持し続ける flock
+#
+# 1 つのワーカーが Firestore から読み込んで公開すると世代番号が進み、他のワーカーは
+# 次のリクエストで世代番号の変化に気づいて新しいファイルを mmap し直す（Firestore は読まない）。
+# 世代番号は書き込み側が lock を持って更新し、読み取り側は変化に気づいたときだけ
+# lock を取って読み直す。
+
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from bank_format import read_bank, write_bank
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_MAGIC = b"KUIZGEN1"
+# magic | 世代番号 u64 | 確認時刻（epoch 秒） f64 | バージョン長 u32 | 予約 u32 | バージョン（JSON）
+_CONTROL = struct.Struct("<8sQdII")
+_CONTROL_SIZE = 4096
+_VERSION_MAX = _CONTROL_SIZE - _CONTROL.size
+# 差し替え直後に古い世代を使っているワーカーがいるため、直前の世代のファイルは残す
+_KEEP_GENERATIONS = 2
+
+
+def encode_version(version) -> Optional[str]:
+    if version is None:
+        return None
+    return json.dumps(version, default=str, ensure_ascii=False)
+
+
+class SharedBank:
+    def __init__(self, directory: Path):
+        if fcntl is None:
+            raise RuntimeError("shared bank requires fcntl (POSIX)")
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._thread_lock = threading.RLock()
+        self._lock_fd = os.open(self.directory / "lock", os.O_RDWR | os.O_CREAT, 0o644)
+        self._leader_fd: Optional[int] = None
+        with self.locked():
+            control = self.directory / "control"
+            fd = os.open(control, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size < _CONTROL_SIZE:
+                    os.ftruncate(fd, _CONTROL_SIZE)
+                self._control = mmap.mmap(fd, _CONTROL_SIZE)
+            finally:
+                os.close(fd)
+            if self._control[:8] != _MAGIC:
+                _CONTROL.pack_into(self._control, 0, _MAGIC, 0, 0.0, 0, 0)
+
+    @contextmanager
+    def locked(self):
+        # flock はプロセス間、RLock は同じプロセス内のスレッド間の排他
+        with self._thread_lock:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def generation(self) -> int:
+        # ロックなしの読み取り（変化の検出だけに使い、読み直しは state() で行う）
+        return struct.unpack_from("<Q", self._control, 8)[0]
+
+    def state(self) -> Tuple[int, float, Optional[str]]:
+        # (世代番号, 確認時刻, バージョン)。locked() の中で呼ぶ
+        _, generation, checked_at, length, _ = _CONTROL.unpack_from(self._control, 0)
+        version = None
+        if length:
+            version = bytes(self._control[_CONTROL.size:_CONTROL.size + length - 1]).decode("utf-8")
+        return generation, checked_at, version
+
+    def _write_state(self, generation: int, version: Optional[str]) -> None:
+        raw = None if version is None else version.encode("utf-8")
+        if raw is not None and len(raw) + 1 > _VERSION_MAX:
+            # 長すぎるバージョンは保存しない（比較できないため毎回読み込み扱いになる）
+            raw = None
+        length = 0 if raw is None else len(raw) + 1
+        if raw is not None:
+            self._control[_CONTROL.size:_CONTROL.size + len(raw)] = raw
+        # 世代番号は最後に書く
+        _CONTROL.pack_into(self._control, 0, _MAGIC, generation, time.time(), length, 0)
+        self._control.flush()
+
+    def touch(self) -> None:
+        # バージョンが変わっていないことを確認した時刻だけを更新する。locked() の中で呼ぶ
+        generation, _, version = self.state()
+        self._write_state(generation, version)
+
+    def bank_path(self, generation: int) -> Path:
+        return self.directory / f"bank.{generation:016d}"
+
+    def publish(self, columns: Dict, version: Optional[str]) -> int:
+        with self.locked():
+            generation = self.generation() + 1
+            write_bank(self.bank_path(generation), columns)
+            self._write_state(generation, version)
+            for path in self.directory.glob("bank.*"):
+                try:
+                    old = int(path.name.split(".")[1])
+                except ValueError:
+                    continue
+                # 削除しても mmap 済みのワーカーは参照を続けられる
+                if old <= generation - _KEEP_GENERATIONS:
+                    path.unlink(missing_ok=True)
+            return generation
+
+    def load(self, generation: int) -> Dict:
+        return read_bank(self.bank_path(generation))
+
+    def acquire_leader(self) -> bool:
+        # プロセスの存続中は保持し続ける（終了すると OS が解放する）
+        if self._leader_fd is not None:
+            return True
+        fd = os.open(self.directory / "leader", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._leader_fd = fd
+        return True
+
+    def release_leader(self) -> None:
+        if self._leader_fd is not None:
+            os.close(self._leader_fd)
+            self._leader_fd = None
+
+    def leader_alive(self) -> bool:
+        # 他のワーカーがリスナーを動かしているか
+        if self._leader_fd is not None:
+            return False
+        fd = os.open(self.directory / "leader", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except OSError:
+            return True
+        finally:
+            os.close(fd)
+        return False
@@ -0,0 +1,236 @@
+# SM-2 による復習スケジュール計算
+#
+# update_schedule は 1 回答分のスカラー版、update_schedule_bulk は配列をまとめて処理する版。
+# bulk 版は NumPy で同じ演算を同じ順序で行うため、結果はスカラー版とビット単位で一致する。
+# NumPy が無い環境ではスカラー版を順に呼び出す。
+#
+#   python sm2.py [--samples 200000] [--seed 0]
+#
+# でランダムな入力に対する両者の一致と処理時間を確認できる。
+
+import argparse
+import math
+import random
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DEFAULT_STATE = (0, 1, 2.5)
+MIN_EASE = 1.3
+# timedelta(days=...) に渡せる上限。これを超える間隔はスカラー版と同じく OverflowError にする
+MAX_INTERVAL_DAYS = timedelta.max.days
+
+State = Tuple[int, int, float]
+
+
+def _advance(repetitions: int, interval: int, ease: float, correct: bool, elapsed_ms: int) -> State:
+    if not correct:
+        quality = 1
+    else:
+        seconds = max(0, elapsed_ms) / 1000.0
+        if seconds <= 5:
+            quality = 5
+        elif seconds <= 12:
+            quality = 4
+        else:
+            quality = 3
+    ease = ease + (0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+    if ease < MIN_EASE:
+        ease = MIN_EASE
+    if quality < 3:
+        repetitions = 0
+        interval = 1
+    else:
+        repetitions += 1
+        if repetitions == 1:
+            interval = 1
+        elif repetitions == 2:
+            interval = 6
+        else:
+            interval = int(interval * ease)
+    return repetitions, interval, ease
+
+
+def update_schedule(
+    repetitions: int,
+    interval: int,
+    ease: float,
+    correct: bool,
+    elapsed_ms: int,
+    now: Optional[datetime] = None,
+):
+    repetitions, interval, ease = _advance(repetitions, interval, ease, correct, elapsed_ms)
+    if now is None:
+        now = datetime.now(timezone.utc)
+    return repetitions, interval, ease, next_review_at(now, interval)
+
+
+def _update_schedule_scalar(repetitions, interval, ease, correct, elapsed_ms):
+    result = ([], [], [])
+    for row in zip(repetitions, interval, ease, correct, elapsed_ms):
+        r, i, e = _advance(*row)
+        # update_schedule と同じく timedelta に収まらない間隔は OverflowError にする
+        timedelta(days=i)
+        result[0].append(r)
+        result[1].append(i)
+        result[2].append(e)
+    return result
+
+
+def update_schedule_bulk(
+    repetitions: Sequence[int],
+    interval: Sequence[int],
+    ease: Sequence[float],
+    correct: Sequence[bool],
+    elapsed_ms: Sequence[int],
+) -> Tuple[List[int], List[int], List[float]]:
+    # 次回復習日時は呼び出し側で next_review_at() により計算する（回答ごとに now を取らない）
+    if np is None:
+        return _update_schedule_scalar(repetitions, interval, ease, correct, elapsed_ms)
+    try:
+        reps = np.asarray(repetitions, dtype=np.int64)
+        ivs = np.asarray(interval, dtype=np.int64)
+        elapsed = np.asarray(elapsed_ms, dtype=np.int64)
+    except OverflowError:
+        # int64 に収まらない入力はスカラー版で処理する
+        return _update_schedule_scalar(repetitions, interval, ease, correct, elapsed_ms)
+    eases = np.asarray(ease, dtype=np.float64)
+    ok = np.asarray(correct, dtype=bool)
+
+    seconds = np.maximum(elapsed, 0).astype(np.float64) / 1000.0
+    quality = np.where(ok, np.where(seconds <= 5, 5, np.where(seconds <= 12, 4, 3)), 1)
+    lapse = 5 - quality
+    new_ease = eases + (0.1 - lapse * (0.08 + lapse * 0.02))
+    new_ease = np.where(new_ease < MIN_EASE, MIN_EASE, new_ease)
+
+    new_reps = np.where(ok, reps + 1, 0)
+    grown = ivs * new_ease
+    grow = ok & (new_reps != 1) & (new_reps != 2)
+    if grow.any():
+        selected = grown[grow]
+        if np.isnan(selected).any():
+            raise ValueError("cannot convert float NaN to integer")
+        if np.isinf(selected).any():
+            raise OverflowError("cannot convert float infinity to integer")
+    truncated = np.trunc(np.where(grow, grown, 0.0))
+    if (np.abs(truncated) > MAX_INTERVAL_DAYS).any():
+        raise OverflowError(f"interval exceeds {MAX_INTERVAL_DAYS} days")
+    new_interval = np.where(grow, truncated.astype(np.int64), np.where(new_reps == 2, 6, 1))
+    return new_reps.tolist(), new_interval.tolist(), new_ease.tolist()
+
+
+def next_review_at(now: datetime, interval: int) -> datetime:
+    return now + timedelta(days=interval)
+
+
+# 重み付き出題で、期限を 1 週間過ぎるごとに加える重み（OVERDUE_CAP_DAYS で頭打ち）
+OVERDUE_WEEK_WEIGHT = 1.0
+OVERDUE_CAP_DAYS = 60
+
+
+def review_weight(state: Optional[Dict], now: datetime) -> float:
+    # 期限を大きく過ぎた問題と ease の低い（苦手な）問題ほど重くする。未回答は 1
+    if not state:
+        return 1.0
+    ease = float(state.get("ease", DEFAULT_STATE[2]))
+    if not math.isfinite(ease):
+        ease = DEFAULT_STATE[2]
+    ease = max(ease, MIN_EASE)
+    weight = DEFAULT_STATE[2] / ease
+    next_review = state.get("nextReviewAt")
+    if isinstance(next_review, datetime) and next_review < now:
+        overdue_days = min((now - next_review).total_seconds() / 86400, OVERDUE_CAP_DAYS)
+        weight *= 1.0 + OVERDUE_WEEK_WEIGHT * overdue_days / 7
+    return weight
+
+
+def replay_schedules(
+    initial: Dict[Hashable, State],
+    events: Sequence[Tuple[Hashable, bool, int]],
+) -> Tuple[Dict[Hashable, State], Dict[Hashable, int]]:
+    # events は (キー, 正誤, 回答時間) の時系列。同じキーの回答は順に適用する必要があるため、
+    # キーごとの出現回数で「ラウンド」に分け、ラウンド内（キーが重複しない）をまとめて計算する。
+    # 戻り値は更新後の状態と、キーごとに最後に適用した events の添字
+    rounds: List[List[int]] = []
+    seen: Counter = Counter()
+    for i, (key, _, _) in enumerate(events):
+        r = seen[key]
+        seen[key] += 1
+        if r == len(rounds):
+            rounds.append([])
+        rounds[r].append(i)
+
+    states = dict(initial)
+    last: Dict[Hashable, int] = {}
+    for indexes in rounds:
+        keys = [events[i][0] for i in indexes]
+        current = [states.get(key, DEFAULT_STATE) for key in keys]
+        reps, ivs, eases = update_schedule_bulk(
+            [s[0] for s in current],
+            [s[1] for s in current],
+            [s[2] for s in current],
+            [events[i][1] for i in indexes],
+            [events[i][2] for i in indexes],
+        )
+        for key, i, r, iv, e in zip(keys, indexes, reps, ivs, eases):
+            states[key] = (r, iv, e)
+            last[key] = i
+    return states, last
+
+
+def _random_inputs(rng: random.Random, n: int):
+    reps = [rng.choice((0, 1, 2, 3, rng.randint(-3, 50))) for _ in range(n)]
+    ivs = [rng.choice((1, 6, rng.randint(-10, 5000), rng.randint(0, 10**6))) for _ in range(n)]
+    eases = [
+        rng.choice((2.5, MIN_EASE, rng.uniform(0.5, 4.0), rng.uniform(1.29, 1.31), float(rng.randint(1, 3))))
+        for _ in range(n)
+    ]
+    correct = [rng.random() < 0.7 for _ in range(n)]
+    elapsed = [
+        rng.choice((5000, 5001, 12000, 12001, 0, -1, rng.randint(-1000, 60000), rng.randint(0, 10**12)))
+        for _ in range(n)
+    ]
+    return reps, ivs, eases, correct, elapsed
+
+
+def verify(samples: int, seed: int = 0) -> int:
+    # スカラー版とビット単位で一致しない行数を返す
+    rng = random.Random(seed)
+    inputs = _random_inputs(rng, samples)
+    expected = _update_schedule_scalar(*inputs)
+    actual = update_schedule_bulk(*inputs)
+    mismatches = 0
+    for i in range(samples):
+        e = (expected[0][i], expected[1][i], expected[2][i])
+        a = (actual[0][i], actual[1][i], actual[2][i])
+        same_float = e[2] == a[2] or (math.isnan(e[2]) and math.isnan(a[2]))
+        if e[:2] != a[:2] or not same_float or math.copysign(1, e[2]) != math.copysign(1, a[2]):
+            mismatches += 1
+    return mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SM-2 の一括計算とスカラー版の一致を確認する")
+    parser.add_argument("--samples", type=int, default=200000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    inputs = _random_inputs(random.Random(args.seed), args.samples)
+    start = time.perf_counter()
+    _update_schedule_scalar(*inputs)
+    scalar_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    update_schedule_bulk(*inputs)
+    bulk_seconds = time.perf_counter() - start
+    mismatches = verify(args.samples, args.seed)
+    print(
+        f"samples={args.samples} mismatches={mismatches} numpy={'yes' if np is not None else 'no'} "
+        f"scalar={scalar_seconds:.3f}s bulk={bulk_seconds:.3f}s"
+    )
+    raise SystemExit(1 if mismatches else 0)
@@ -0,0 +1,301 @@
+# SQLite によるローカルストア（Firestore を使わない単一ノード構成向け）
+#
+#   python sqlite_store.py [--path ~/.local/state/quiz/quiz.sqlite3]
+#
+# で data/*.json の問題を questions テーブルに取り込む（全件置き換え、バージョンを更新）。
+# main.FirestoreStore と同じメソッドを持ち、QUIZ_STORE=sqlite（または auto で Firestore に
+# 接続できない場合）のときに使われる。WAL モードで開くため、同じファイルを複数の
+# ワーカープロセスから読み書きできる。日時は UTC の epoch マイクロ秒で保存する。
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+
+from ingest import DATA_DIR, STATE_DIR, content_hash, ingest, source_files
+from metrics import record_ops
+
+DEFAULT_PATH = Path(os.getenv("QUIZ_SQLITE_PATH") or STATE_DIR / "quiz.sqlite3")
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS questions (
+    position INTEGER PRIMARY KEY,
+    id TEXT NOT NULL,
+    category TEXT NOT NULL,
+    question TEXT NOT NULL,
+    options TEXT NOT NULL,
+    answer INTEGER NOT NULL,
+    explanation TEXT,
+    content_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS questions_id ON questions (id);
+CREATE TABLE IF NOT EXISTS user_question_state (
+    user_id TEXT NOT NULL,
+    question_id TEXT NOT NULL,
+    repetitions INTEGER NOT NULL,
+    interval INTEGER NOT NULL,
+    ease REAL NOT NULL,
+    next_review_at INTEGER,
+    updated_at INTEGER,
+    PRIMARY KEY (user_id, question_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS user_question_state_review ON user_question_state (user_id, next_review_at);
+CREATE TABLE IF NOT EXISTS answers (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    question_id TEXT NOT NULL,
+    choice INTEGER NOT NULL,
+    correct INTEGER NOT NULL,
+    elapsed_ms INTEGER NOT NULL,
+    created_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS answers_user_created ON answers (user_id, created_at);
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id TEXT PRIMARY KEY,
+    total_answers INTEGER NOT NULL,
+    correct_count INTEGER NOT NULL,
+    total_elapsed_ms INTEGER NOT NULL,
+    last_answered_at INTEGER
+);
+"""
+
+
+def _to_micros(value: Optional[datetime]) -> Optional[int]:
+    if value is None:
+        return None
+    delta = value - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+def _from_micros(value: Optional[int]) -> Optional[datetime]:
+    if value is None:
+        return None
+    return _EPOCH + timedelta(microseconds=value)
+
+
+def _state_dict(user_id: str, row) -> Dict:
+    question_id, repetitions, interval, ease, next_review_at, updated_at = row
+    return {
+        "userId": user_id,
+        "questionId": question_id,
+        "repetitions": repetitions,
+        "interval": interval,
+        "ease": ease,
+        "nextReviewAt": _from_micros(next_review_at),
+        "updatedAt": _from_micros(updated_at),
+    }
+
+
+class SqliteStore:
+    name = "sqlite"
+
+    def __init__(self, path: Path = DEFAULT_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # 1 接続をロックで直列化して共有する（スレッドプールの複数スレッドから使う）
+        self._conn = sqlite3.connect(str(self.path), isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("PRAGMA busy_timeout=5000")
+            self._conn.execute("PRAGMA temp_store=MEMORY")
+            self._conn.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _read(self, sql: str, params: Sequence = ()) -> List[tuple]:
+        start = time.perf_counter()
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        record_ops({"reads": len(rows), "queries": 1}, time.perf_counter() - start)
+        return rows
+
+    # 問題
+
+    def load_questions(self) -> List[Dict]:
+        rows = self._read(
+            "SELECT id, category, question, options, answer, explanation FROM questions ORDER BY position"
+        )
+        return [
+            {
+                "id": qid,
+                "category": category,
+                "question": question,
+                "options": json.loads(options),
+                "answer": answer,
+                "explanation": explanation,
+            }
+            for qid, category, question, options, answer, explanation in rows
+        ]
+
+    def bank_version(self) -> Optional[str]:
+        rows = self._read("SELECT value FROM meta WHERE key = 'questions.version'")
+        return rows[0][0] if rows else None
+
+    def replace_questions(self, records: Iterable[Dict]) -> int:
+        rows = [
+            (
+                pos,
+                r["id"],
+                r["category"],
+                r["question"],
+                json.dumps(r["options"], ensure_ascii=False),
+                r["answer"],
+                r.get("explanation"),
+                content_hash(r),
+            )
+            for pos, r in enumerate(records)
+        ]
+        version = datetime.now(timezone.utc).isoformat()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM questions")
+                self._conn.executemany(
+                    "INSERT INTO questions VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+                )
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('questions.version', ?)", (version,)
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return len(rows)
+
+    # 学習状態・回答・統計（main.FirestoreStore と同じインターフェース）
+    # sqlite3 の呼び出しはブロックするため、イベントループではなくスレッドプールで実行する
+
+    async def load_user_states(self, user_id: str) -> Dict[str, Dict]:
+        rows = await run_in_threadpool(
+            self._read,
+            "SELECT question_id, repetitions, interval, ease, next_review_at, updated_at "
+            "FROM user_question_state WHERE user_id = ?",
+            (user_id,),
+        )
+        return {row[0]: _state_dict(user_id, row) for row in rows}
+
+    async def get_user_states(self, user_id: str, question_ids: Sequence[str]) -> Dict[str, Dict]:
+        if len(question_ids) == 1:
+            rows = await run_in_threadpool(
+                self._read,
+                "SELECT question_id, repetitions, interval, ease, next_review_at, updated_at "
+                "FROM user_question_state WHERE user_id = ? AND question_id = ?",
+                (user_id, question_ids[0]),
+            )
+        else:
+            rows = await run_in_threadpool(
+                self._read,
+                "SELECT question_id, repetitions, interval, ease, next_review_at, updated_at "
+                "FROM user_question_state WHERE user_id = ? AND question_id IN "
+                "(SELECT value FROM json_each(?))",
+                (user_id, json.dumps(list(question_ids))),
+            )
+        return {row[0]: _state_dict(user_id, row) for row in rows}
+
+    async def record_answers(
+        self, user_id: str, answers: List[Dict], states: Dict[str, Dict], now: datetime
+    ) -> None:
+        # 回答・状態・統計を 1 トランザクションで書き込む
+        answer_rows = [
+            (
+                user_id,
+                a["questionId"],
+                a["choice"],
+                1 if a["correct"] else 0,
+                a["elapsedMs"],
+                _to_micros(a["createdAt"]),
+            )
+            for a in answers
+        ]
+        state_rows = [
+            (
+                user_id,
+                qid,
+                s["repetitions"],
+                s["interval"],
+                s["ease"],
+                _to_micros(s["nextReviewAt"]),
+                _to_micros(s["updatedAt"]),
+            )
+            for qid, s in states.items()
+        ]
+        correct = sum(1 for a in answers if a["correct"])
+        elapsed = sum(max(0, int(a["elapsedMs"])) for a in answers)
+        await run_in_threadpool(
+            self._write_answers, user_id, answer_rows, state_rows, correct, elapsed, _to_micros(now)
+        )
+
+    def _write_answers(
+        self,
+        user_id: str,
+        answer_rows: List[tuple],
+        state_rows: List[tuple],
+        correct: int,
+        elapsed: int,
+        now_micros: int,
+    ) -> None:
+        start = time.perf_counter()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO answers (user_id, question_id, choice, correct, elapsed_ms, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    answer_rows,
+                )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO user_question_state VALUES (?, ?, ?, ?, ?, ?, ?)", state_rows
+                )
+                self._conn.execute(
+                    "INSERT INTO user_stats VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (user_id) DO UPDATE SET "
+                    "total_answers = total_answers + excluded.total_answers, "
+                    "correct_count = correct_count + excluded.correct_count, "
+                    "total_elapsed_ms = total_elapsed_ms + excluded.total_elapsed_ms, "
+                    "last_answered_at = excluded.last_answered_at",
+                    (user_id, len(answer_rows), correct, elapsed, now_micros),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        record_ops(
+            {"writes": len(answer_rows) + len(state_rows) + 1, "commits": 1}, time.perf_counter() - start
+        )
+
+    async def get_stats(self, user_id: str) -> Tuple[int, int]:
+        rows = await run_in_threadpool(
+            self._read,
+            "SELECT total_answers, correct_count FROM user_stats WHERE user_id = ?", (user_id,)
+        )
+        if rows:
+            return rows[0][0], rows[0][1]
+        return 0, 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="data/*.json の問題を SQLite ストアに取り込む")
+    parser.add_argument("--path", type=Path, default=DEFAULT_PATH)
+    args = parser.parse_args()
+
+    store = SqliteStore(args.path)
+    count = store.replace_questions(ingest(source_files(DATA_DIR)))
+    store.close()
+    print(f"Imported {count} questions into {args.path}")